@@ -1,70 +1,257 @@
 import xmltodict
-import xlsxwriter
 import os
-from json import loads, dumps
-import logging
+from json import dumps
+import re
 import shutil
+import time
+from contextlib import contextmanager
+from io import BytesIO
+from xml.etree import ElementTree
+from formats import FORMATS, SIDECAR_SUFFIX, XlsxOutput, sidecar
+from reconcile import AmountTotals
+from record import MISSING, Record
+from usk import USKResolver
+
+# Ab dieser Anzahl Datensätze wird das Workbook im constant_memory-Modus geschrieben
+CONSTANT_MEMORY_THRESHOLD = 20000
+# Alle wie viele Datensätze export() den Fortschritt meldet
+PROGRESS_INTERVAL = 1000
+# Spalten der Ausgaben und Felder des Blatts "Informationen" (Invoice.header)
+COLUMNS = ("Verfahren", "USK", "Betrag", "Währung", "Einzahler", "Verwendungszweck", "Zeitstempel", "Bezahlmethode")
+HEADER_FIELDS = ("FileSender", "FileName", "FileTimestamp", "PeriodFrom", "PeriodTo", "Amount", "Currency", "Purpose")
+
+
+def _local_name(tag):
+    # "{namespace}Tag" -> "Tag", damit die Schlüssel wie bei xmltodict aussehen
+    return tag.rsplit("}", 1)[-1]
+
+
+def _element_value(elem):
+    # Nachbau der xmltodict-Abbildung: Blatt -> Text (leer -> None), sonst dict
+    text = elem.text.strip() if elem.text else ""
+    if not len(elem) and not elem.attrib:
+        return text or None
+    value = {"@" + _local_name(key): val for key, val in elem.attrib.items()}
+    for child in elem:
+        key = _local_name(child.tag)
+        item = _element_value(child)
+        if key not in value:
+            value[key] = item
+        elif type(value[key]) is list:
+            value[key].append(item)
+        else:
+            value[key] = [value[key], item]
+    if text:
+        value["#text"] = text
+    return value
+
+
+@contextmanager
+def _open_source(source):
+    # Quelle darf ein Pfad, bytes oder ein file-artiges Objekt sein
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield BytesIO(source)
+    elif hasattr(source, "read"):
+        source.seek(0)
+        yield source
+    else:
+        with open(source, "rb") as fd:
+            yield fd
+
+
+def read_header(source):
+    # Liest nur den PSPData-Block, der Rest der Datei wird nicht angefasst
+    with _open_source(source) as fd:
+        for event, elem in ElementTree.iterparse(fd, events=("end",)):
+            if _local_name(elem.tag) == "PSPData":
+                return _element_value(elem)
+    raise KeyError("PSPData")
+
+
+def _record(elem):
+    # RecordEntry-Element -> Record, ohne den Umweg über ein verschachteltes dict
+    fields = {}
+    for child in elem:
+        if len(child) or child.attrib:
+            fields[_local_name(child.tag)] = _element_value(child)
+        else:
+            text = child.text.strip() if child.text else ""
+            fields[_local_name(child.tag)] = text or None
+    return Record.from_fields(fields)
+
+
+def iter_records(source):
+    # Liefert die RecordEntry-Elemente einzeln als Record und verwirft sie danach
+    # wieder, damit der Speicherbedarf unabhängig von der Anzahl der Datensätze bleibt
+    records = None
+    with _open_source(source) as fd:
+        for event, elem in ElementTree.iterparse(fd, events=("start", "end")):
+            tag = _local_name(elem.tag)
+            if event == "start":
+                if tag == "Records":
+                    records = elem
+            elif tag == "RecordEntry":
+                yield _record(elem)
+                elem.clear()
+                if records is not None:
+                    records.clear()
+
+
+def iter_usk_fields(source):
+    # Nur epay21App und Purpose jedes RecordEntry (für die Vorabprüfung); fehlt
+    # Purpose, kommt wie beim Record der Platzhalter
+    app = None
+    purpose = MISSING
+    records = None
+    with _open_source(source) as fd:
+        for event, elem in ElementTree.iterparse(fd, events=("start", "end")):
+            if event == "start":
+                if records is None and _local_name(elem.tag) == "Records":
+                    records = elem
+                continue
+            if records is None:
+                continue
+            tag = _local_name(elem.tag)
+            if tag == "epay21App":
+                app = elem.text.strip() if elem.text else None
+            elif tag == "Purpose":
+                purpose = (elem.text.strip() if elem.text else "") or None
+            elif tag == "RecordEntry":
+                yield app, purpose
+                app = None
+                purpose = MISSING
+                elem.clear()
+                records.clear()
+
+
+_RECORD_TAG = re.compile(rb"<(?:[\w.-]+:)?RecordEntry[\s/>]")
+
+
+def count_records(source):
+    # Zählt die RecordEntry-Tags direkt im Byte-Strom, ohne XML zu parsen
+    count = 0
+    tail = b""
+    with _open_source(source) as fd:
+        while True:
+            chunk = fd.read(1 << 20)
+            if not chunk:
+                return count + len(_RECORD_TAG.findall(tail))
+            buffer = tail + chunk
+            # Ab dem letzten "<" könnte ein Tag über die Blockgrenze reichen
+            cut = buffer.rfind(b"<")
+            if cut < 0:
+                cut = len(buffer)
+            count += len(_RECORD_TAG.findall(buffer, 0, cut))
+            tail = buffer[cut:]
+
+
+_RECORDS_START = re.compile(rb"<(?:[\w.-]+:)?Records[\s/>]")
+_RECORDS_END = re.compile(rb"</(?:[\w.-]+:)?Records\s*>")
+_RECORD_END = re.compile(rb"</(?:[\w.-]+:)?RecordEntry\s*>")
+
+
+def split_records(data, chunk_bytes):
+    # Teilt eine Datei (bytes) an RecordEntry-Grenzen in eigenständige Dokumente:
+    # alles bis einschließlich <Records>, ein Stück der Datensätze, ab </Records>
+    # bis zum Ende. Jedes Stück lässt sich mit iter_records lesen, hintereinander
+    # ergeben sie dieselben Datensätze in derselben Reihenfolge. Ohne erkennbaren
+    # Records-Block kommt die Datei unverändert als einziges Stück zurück.
+    start = _RECORDS_START.search(data)
+    if start is None:
+        yield data
+        return
+    body_start = data.index(b">", start.start()) + 1
+    end = None if data[body_start - 2:body_start] == b"/>" else _RECORDS_END.search(data, body_start)
+    if end is None:
+        yield data
+        return
+    prefix, suffix = data[:body_start], data[end.start():]
+    position = body_start
+    while position < end.start():
+        cut = end.start()
+        if position + chunk_bytes < cut:
+            match = _RECORD_END.search(data, position + chunk_bytes, cut)
+            if match is not None:
+                cut = match.end()
+        yield prefix + data[position:cut] + suffix
+        position = cut
+
+
+def output_name(file, suffix=".xlsx"):
+    # Endung in beliebiger Schreibweise (B.XML) ersetzen, sonst überschreiben sich die Ausgaben
+    return os.path.splitext(file)[0] + suffix
 
 
 class Invoice:
 
-    def __init__(self, file, config):
-        self.filepath = config["files"]["source_path"] + file
-        self.source_path = config["files"]["source_path"]
+    def __init__(self, file, config, resolver=None, source=None, metrics=None):
+        # Ohne source wird die Datei aus files.source_path gelesen (Stapelbetrieb),
+        # sonst direkt aus bytes bzw. einem file-artigen Objekt (Web-Upload)
+        files = config.get("files", {})
+        self.source_path = files.get("source_path", "")
+        self.filepath = self.source_path + file
+        self.source = source if source is not None else self.filepath
         self.file = file
-        with open(self.filepath, "r", encoding="utf-8") as fd:
-            self.config = config
-            self.doc = xmltodict.parse(fd.read())
-            self.FileSender = self.doc["epay21Finance"]["PSPData"]["FileSender"]
-            self.FileName = self.doc["epay21Finance"]["PSPData"]["FileName"]
-            # self.OutputFile = config["files"]["destination_path"]+self.FileName.split(".")[0]+".xlsx"
-            self.OutputFile = config["files"]["destination_path"] + file.replace(".xml", ".xlsx")
-            self.FileTimestamp = self.doc["epay21Finance"]["PSPData"]["FileTimestamp"]
-            self.PeriodFrom = self.doc["epay21Finance"]["PSPData"]["PeriodFrom"]
-            self.PeriodTo = self.doc["epay21Finance"]["PSPData"]["PeriodTo"]
-            self.Amount = self.doc["epay21Finance"]["PSPData"]["Amount"]
-            self.Currency = self.doc["epay21Finance"]["PSPData"]["Currency"]
-            if "Purpose" in self.doc["epay21Finance"]["PSPData"]:
-                self.Purpose = self.doc["epay21Finance"]["PSPData"]["Purpose"]
-            else:
-                self.Purpose = "n/a"
-            self.columns = ["Verfahren", "USK", "Betrag", "Währung", "Einzahler", "Verwendungszweck", "Zeitstempel",
-                            "Bezahlmethode"]
-            self.RecordEntry = self.doc["epay21Finance"]["Records"]["RecordEntry"]
+        self.config = config
+        # Optional: metrics.Metrics sammelt Zeiten pro Stufe und Mengen
+        self.metrics = metrics
+        # Die USK-Liste wird einmal pro Stapel kompiliert und kann übergeben werden
+        self.resolver = resolver if resolver is not None else USKResolver.from_config(config)
+        start = time.perf_counter()
+        header = read_header(self.source)
+        if metrics is not None:
+            metrics.add_time("header", time.perf_counter() - start)
+        self.FileSender = header["FileSender"]
+        self.FileName = header["FileName"]
+        # self.OutputFile = config["files"]["destination_path"]+self.FileName.split(".")[0]+".xlsx"
+        self.OutputName = output_name(file)
+        if "destination_path" in files:
+            self.OutputFile = files["destination_path"] + self.OutputName
+        else:
+            self.OutputFile = None
+        self.FileTimestamp = header["FileTimestamp"]
+        self.PeriodFrom = header["PeriodFrom"]
+        self.PeriodTo = header["PeriodTo"]
+        self.Amount = header["Amount"]
+        self.Currency = header["Currency"]
+        if "Purpose" in header:
+            self.Purpose = header["Purpose"]
+        else:
+            self.Purpose = "n/a"
+        self.columns = list(COLUMNS)
+        # Nach export(): Abgleich der Beträge mit dem Kopf (siehe reconcile.AmountTotals.summary)
+        self.reconciliation = None
+        # Alle (App, Schlüssel)-Paare, die diese Datei aufgelöst hat
+        self.used = set()
+
+    # Vollständiger Baum, nur noch für Debugging (lädt die ganze Datei)
+    @property
+    def doc(self):
+        with _open_source(self.source) as fd:
+            return xmltodict.parse(fd.read())
+
+    @property
+    def RecordEntry(self):
+        return self.doc["epay21Finance"]["Records"]["RecordEntry"]
+
+    def records(self):
+        return iter_records(self.source)
 
     # Form debugging purposes
     def pprint(self):
         print(dumps(self.doc, indent=4, sort_keys=True))
 
-    def get_USK(self, RecordEntry):
-        usk_config = loads(self.config["usk"]["usk_liste"].replace("\'", "\""))
-        usk = usk_config[RecordEntry["epay21App"]]
-        if RecordEntry["epay21App"] == "hsh.olav":
-            usk = usk_config["hsh.olav"][RecordEntry["Purpose"].split("/")[0]]
-        if RecordEntry["epay21App"] == "civento":
-            usk = usk_config["civento"][RecordEntry["Purpose"].split("-")[0]]
-        return usk
-
-    def create_table(self, sheet, row, RecordEntry):
-        sheet.write(row, 0, RecordEntry["epay21App"])
-        sheet.write(row, 1, self.get_USK(RecordEntry))
-        sheet.write(row, 2, RecordEntry["Amount"])
-        sheet.write(row, 3, RecordEntry["Currency"])
-        sheet.write(row, 4, RecordEntry["PayerInfo"])
-        sheet.write(row, 5, RecordEntry["Purpose"])
-        sheet.write(row, 6, RecordEntry["Timestamp"])
-        sheet.write(row, 7, RecordEntry["PayMethod"])
-
-    def create_file(self):
-        try:
-            workbook = xlsxwriter.Workbook(self.OutputFile)
-        except:
-            logger.debug(self.OutputFile + (" konnte nicht erstelt werden"))
-
-        sheet1 = workbook.add_worksheet("Informationen")
-        sheet2 = workbook.add_worksheet("Daten")
-
-        basicdata = (
+    def get_USK(self, record):
+        return self.resolver.resolve(record.epay21App, record.Purpose, self.used)
+
+    def row_values(self, record):
+        return record.values(self.get_USK(record))
+
+    def create_table(self, sheet, row, record):
+        sheet.write_row(row, 0, self.row_values(record))
+
+    def header(self):
+        return (
             ["FileSender", self.FileSender],
             ["FileName", self.FileName],
             ["FileTimestamp", self.FileTimestamp],
@@ -75,52 +262,127 @@ class Invoice:
             ["Purpose", self.Purpose],
         )
 
-        row = 0
-        for key, value in (basicdata):
-            sheet1.write(row, 0, key)
-            sheet1.write(row, 1, value)
-            row += 1
-
-        sheet1.set_column(0, 0, 15)
-        sheet1.set_column(1, 1, 70)
-
-        for name in self.columns:
-            sheet2.write(0, self.columns.index(name), name)
-
-        row = 1
-        if type(self.RecordEntry) is list:
-            for entry in self.RecordEntry:
-                if "Purpose" not in entry:
-                    entry["Purpose"] = "n/v"
-                if "PayerInfo" not in entry:
-                    entry["PayerInfo"] = "n/v"
-                self.create_table(sheet2, row, entry)
-                row += 1
+    def rows(self):
+        # Fehlende Purpose/PayerInfo stehen bereits als "n/v" im Record
+        for record in self.records():
+            yield self.row_values(record)
+
+    def use_constant_memory(self):
+        return count_records(self.source) > CONSTANT_MEMORY_THRESHOLD
+
+    def create_file(self, output=None, constant_memory=None):
+        # output: Zielpfad oder BytesIO, Standard ist destination_path + Dateiname.
+        # constant_memory: None = automatisch ab CONSTANT_MEMORY_THRESHOLD Datensätzen
+        if output is None:
+            output = self.OutputFile
+        if constant_memory is None:
+            constant_memory = self.use_constant_memory()
+        writer = XlsxOutput(self.header(), self.columns, output=output, constant_memory=constant_memory)
+        for values in self.rows():
+            writer.write_row(values)
+        writer.close()
+        return output
+
+    def to_bytes(self):
+        buffer = BytesIO()
+        self.create_file(buffer)
+        return buffer.getvalue()
+
+    def export(self, formats=("xlsx",), progress=None, rows=None):
+        # Ein einziger Durchlauf über die Datensätze für alle gewählten Formate;
+        # Ergebnis: Liste von {"name", "suffix", "content"}. progress(anzahl) wird
+        # alle PROGRESS_INTERVAL Datensätze aufgerufen und darf abbrechen (Exception).
+        # rows: fertige Zeilenwerte statt self.rows() (siehe conversion.convert_sharded)
+        start = time.perf_counter()
+        # Zählt die Datensätze der ganzen Datei: gehört zum Parsen, nicht zum Schreiben
+        constant_memory = "xlsx" in formats and self.use_constant_memory()
+        if self.metrics is not None:
+            self.metrics.add_time("parse", time.perf_counter() - start)
+        start = time.perf_counter()
+        writers = []
+        for fmt in formats:
+            if fmt == "xlsx":
+                writers.append(XlsxOutput(self.header(), self.columns, constant_memory=constant_memory))
+            else:
+                writers.append(FORMATS[fmt](self.header(), self.columns))
+        if self.metrics is not None:
+            self.metrics.add_time("write", time.perf_counter() - start)
+        outputs = [{"suffix": writer.suffix, "content": content}
+                   for writer, content in zip(writers, self.write(writers, progress, rows))]
+        if any(fmt != "xlsx" for fmt in formats):
+            outputs.append({"suffix": SIDECAR_SUFFIX, "content": sidecar(self.header())})
+        for output in outputs:
+            output["name"] = output_name(self.file, output["suffix"])
+        return outputs
+
+    def write(self, writers, progress=None, rows=None):
+        # Gibt jede Zeile an alle writers und den Betragsabgleich; Ergebnis ist
+        # close() jedes writers (für die zusammengefasste Arbeitsmappe z.B. die Zeilen)
+        totals = AmountTotals()
+        sinks = writers + [totals]
+        if self.metrics is None or rows is not None:
+            count = 0
+            for values in self.rows() if rows is None else rows:
+                for writer in sinks:
+                    writer.write_row(values)
+                count += 1
+                if progress is not None and count % PROGRESS_INTERVAL == 0:
+                    progress(count)
+            contents = [writer.close() for writer in writers]
         else:
-            if "Purpose" not in self.RecordEntry:
-                self.RecordEntry["Purpose"] = "n/v"
-            if "PayerInfo" not in self.RecordEntry:
-                self.RecordEntry["PayerInfo"] = "n/v"
-            self.create_table(sheet2, row, self.RecordEntry)
-
-        sheet1.set_column(0, 0, 15)
-        sheet1.set_column(1, 1, 70)
-        sheet2.set_column(0, 0, 15)
-        sheet2.set_column(1, 1, 15)
-        sheet2.set_column(2, 2, 15)
-        sheet2.set_column(3, 3, 15)
-        sheet2.set_column(4, 4, 40)
-        sheet2.set_column(5, 5, 40)
-        sheet2.set_column(6, 6, 40)
-        sheet2.set_column(7, 7, 15)
-        workbook.close()
-        return self.OutputFile
+            contents = self._export_measured(writers, sinks, progress)
+            count = self.metrics.counts.get("records", 0)
+        start = time.perf_counter()
+        self.reconciliation = totals.summary(self.Amount)
+        if self.metrics is not None:
+            self.metrics.add_time("reconcile", time.perf_counter() - start)
+        if progress is not None:
+            progress(count)
+        return contents
+
+    def _export_measured(self, writers, sinks, progress=None):
+        # Wie write(), aber mit getrennter Zeitmessung für Parsen, USK-Auflösung
+        # und Schreiben (zwei perf_counter-Aufrufe mehr pro Datensatz)
+        clock = time.perf_counter
+        parse = usk = write = 0.0
+        count = 0
+        records = self.records()
+        while True:
+            start = clock()
+            record = next(records, None)
+            parsed = clock()
+            parse += parsed - start
+            if record is None:
+                break
+            values = self.row_values(record)
+            resolved = clock()
+            usk += resolved - parsed
+            for writer in sinks:
+                writer.write_row(values)
+            write += clock() - resolved
+            count += 1
+            if progress is not None and count % PROGRESS_INTERVAL == 0:
+                progress(count)
+        start = clock()
+        contents = [writer.close() for writer in writers]
+        write += clock() - start
+
+        self.metrics.add_time("parse", parse)
+        self.metrics.add_time("usk", usk)
+        self.metrics.add_time("write", write)
+        self.metrics.count("records", count)
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            self.metrics.count("bytes_in", len(self.source))
+        elif isinstance(self.source, str):
+            self.metrics.count("bytes_in", os.path.getsize(self.source))
+        self.metrics.count("bytes_out", sum(len(content) for content in contents if isinstance(content, bytes)))
+        return contents
 
     def cleanup(self):
         if os.path.isfile(self.OutputFile) and os.stat(self.OutputFile).st_size > 0:
             try:
-                if not os.path.isdir(self.source_path + "/Archiv/"):
-                    os.mkdir(self.source_path + "/Archiv/")
+                # Mehrere Worker archivieren gleichzeitig
+                os.makedirs(self.source_path + "/Archiv/", exist_ok=True)
                 shutil.move(self.filepath, self.source_path + "/Archiv/" + self.file)
             except Exception as e:
                 print(e)
@@ -0,0 +1,246 @@
+# HTTP-Schnittstelle für andere Fachverfahren: XML rein, XLSX bzw. ZIP raus.
+# Nutzt denselben Ablauf wie die Weboberfläche (jobs.ConversionJob: Vorabprüfung,
+# Dateiverzeichnis, Cache, Worker-Pool), hält aber keinen Zustand pro Client.
+#
+#   uvicorn api:app --host 0.0.0.0 --port 8000
+#
+#   curl -F files=@export.xml -o export.xlsx http://localhost:8000/convert
+#   curl -F files=@a.xml -F files=@b.xml -F config=@usk.json -o export.zip http://localhost:8000/convert
+#   curl -H "Content-Type: application/xml" --data-binary @export.xml -o export.xlsx \
+#        "http://localhost:8000/convert?name=export.xml"
+#
+# Parameter (Formularfeld oder Query): formats=xlsx,csv,... und consolidated=1 für
+# eine Arbeitsmappe aller Dateien. Ohne config gilt configs/current_config.json.
+# Gleichzeitige Anfragen sind auf INVOICE_API_CONCURRENCY begrenzt, bis zu
+# INVOICE_API_QUEUE weitere warten, alles darüber bekommt 503. Nach
+# INVOICE_API_TIMEOUT Sekunden (Warten plus Konvertierung) wird abgebrochen (504).
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from cache import result_cache
+from conversion import DEFAULT_FORMATS, shutdown, worker_count
+from formats import FORMATS
+from jobs import BLOCKED, CANCELLED, DONE, ConversionJob
+from metrics import registry
+from reconcile import is_balanced
+
+logger = logging.getLogger("Invoice Parser")
+
+CONFIG_FILE = os.path.join("configs", "current_config.json")
+DEFAULT_QUEUE = 16
+DEFAULT_TIMEOUT = 300
+DEFAULT_MAX_MB = 200
+# Wie oft der Stand eines laufenden Jobs abgefragt wird (Sekunden)
+POLL_INTERVAL = 0.05
+# Vorschlag an den Aufrufer bei voller Warteschlange (Sekunden)
+RETRY_AFTER = 5
+
+MEDIA_TYPES = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".zip": "application/zip",
+    ".csv": "text/csv; charset=utf-8",
+    ".jsonl": "application/x-ndjson",
+    ".parquet": "application/vnd.apache.parquet",
+}
+XML_TYPES = ("application/xml", "text/xml")
+
+
+class RequestError(Exception):
+
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+    def response(self):
+        headers = {"Retry-After": str(RETRY_AFTER)} if self.status == 503 else None
+        return JSONResponse({"error": str(self), **self.details}, status_code=self.status, headers=headers)
+
+
+class Limiter:
+    # Höchstens concurrency Konvertierungen gleichzeitig, höchstens queue wartende;
+    # die Worker-Prozesse selbst teilen sich alle Anfragen (conversion.get_executor)
+
+    def __init__(self, concurrency, queue):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.active = 0
+
+    @asynccontextmanager
+    async def slot(self, timeout):
+        if self.waiting >= self.queue:
+            raise RequestError(503, "Zu viele Anfragen, bitte später erneut versuchen.")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise RequestError(504, "Zeitüberschreitung in der Warteschlange.")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+
+def _flag(value):
+    return str(value).lower() in ("1", "true", "yes", "ja")
+
+
+def _parse_formats(value):
+    formats = tuple(fmt.strip() for fmt in value.split(",") if fmt.strip()) if value else DEFAULT_FORMATS
+    unknown = [fmt for fmt in formats if fmt not in FORMATS]
+    if unknown:
+        raise RequestError(400, f"Unbekanntes Format: {', '.join(unknown)}", formats=sorted(FORMATS))
+    return formats
+
+
+def _parse_config(content):
+    if content is None:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as fd:
+            return json.load(fd)
+    try:
+        usk_config = json.loads(content)
+    except ValueError as e:
+        raise RequestError(400, f"USK-Liste ist kein gültiges JSON: {e}")
+    if not isinstance(usk_config, dict):
+        raise RequestError(400, "USK-Liste muss ein JSON-Objekt sein.")
+    return usk_config
+
+
+async def read_upload(request, max_bytes):
+    # -> (Dateien, USK-Liste oder None, Parameter); multipart mit Feldern files/config
+    # oder der rohe XML-Body einer einzelnen Datei
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise RequestError(413, f"Anfrage größer als {max_bytes // (1024 * 1024)} MB.")
+    params = dict(request.query_params)
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(XML_TYPES):
+        body = await request.body()
+        if len(body) > max_bytes:
+            raise RequestError(413, f"Anfrage größer als {max_bytes // (1024 * 1024)} MB.")
+        return [(os.path.basename(params.get("name", "upload.xml")), body)], None, params
+    if not content_type.startswith("multipart/form-data"):
+        raise RequestError(415, "Erwartet multipart/form-data (Felder files, config) oder application/xml.")
+
+    files = []
+    config = None
+    size = 0
+    async with request.form(max_files=1000) as form:
+        for key, value in form.multi_items():
+            if hasattr(value, "read"):
+                content = await value.read()
+                size += len(content)
+                if size > max_bytes:
+                    raise RequestError(413, f"Anfrage größer als {max_bytes // (1024 * 1024)} MB.")
+                if key == "config":
+                    config = content
+                else:
+                    files.append((os.path.basename(value.filename or f"upload_{len(files) + 1}.xml"), content))
+            elif key == "config":
+                config = value
+            else:
+                params[key] = value
+    if not files:
+        raise RequestError(400, "Keine XML-Datei übergeben (Feld files).")
+    return files, config, params
+
+
+async def convert(request):
+    settings = request.app.state.settings
+    deadline = time.monotonic() + settings["timeout"]
+    try:
+        files, config, params = await read_upload(request, settings["max_bytes"])
+        formats = _parse_formats(params.get("formats"))
+        usk_config = _parse_config(config)
+        consolidated = _flag(params.get("consolidated", ""))
+        async with request.app.state.limiter.slot(deadline - time.monotonic()):
+            # Fair über die aufrufenden Systeme hinweg, neben den Sitzungen der Oberfläche
+            client = f"api:{request.client.host}" if request.client else "api"
+            # partial=False: bei 422 wird nichts ausgeliefert, also auch nichts ins Dateiverzeichnis
+            job = ConversionJob(files, usk_config, formats, result_cache, settings["workers"], consolidated, client,
+                                partial=False)
+            job.start()
+            while not job.done:
+                if time.monotonic() > deadline:
+                    job.cancel()
+                    raise RequestError(504, f"Konvertierung nach {settings['timeout']} Sekunden abgebrochen.")
+                await asyncio.sleep(POLL_INTERVAL)
+    except RequestError as e:
+        return e.response()
+
+    for message in job.log:
+        logger.info(message)
+    if job.status == BLOCKED:
+        return JSONResponse({"error": "Fehlende USK-Zuordnungen, es wurde nichts konvertiert.",
+                             "missing": job.preflight["missing"]}, status_code=422)
+    if job.status == CANCELLED:
+        return JSONResponse({"error": "Konvertierung abgebrochen."}, status_code=503)
+    if job.status != DONE:
+        return JSONResponse({"error": "Interner Fehler bei der Konvertierung."}, status_code=500)
+    errors = {result["source"]: result["error"] for result in job.results if result["error"]}
+    if errors or job.download_name is None:
+        # Ganz oder gar nicht: der Aufrufer schickt den Stapel nach der Korrektur erneut
+        return JSONResponse({"error": "Nicht alle Dateien konnten konvertiert werden.", "errors": errors,
+                             "log": job.log}, status_code=422)
+
+    name = job.download_name
+    summaries = [result["reconciliation"] for result in job.results if result.get("reconciliation")]
+    headers = {
+        "Content-Disposition": f'attachment; filename="{name}"',
+        "X-Invoice-Files": str(len(job.results)),
+        "X-Invoice-Duplicates": str(sum(1 for check in job.ledger_checks or () if check["duplicate"])),
+        "X-Invoice-Mismatches": str(sum(1 for summary in summaries if not is_balanced(summary))),
+        "X-Invoice-Seconds": f"{job.seconds:.3f}",
+    }
+    return Response(job.download_content(), media_type=MEDIA_TYPES.get(os.path.splitext(name)[1]),
+                    headers=headers)
+
+
+async def health(request):
+    limiter = request.app.state.limiter
+    return JSONResponse({"status": "ok", "workers": request.app.state.settings["workers"],
+                         "active": limiter.active, "waiting": limiter.waiting})
+
+
+async def metrics(request):
+    return PlainTextResponse(registry.to_prometheus())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    workers = worker_count()
+    app.state.settings = {
+        "workers": workers,
+        "timeout": float(os.environ.get("INVOICE_API_TIMEOUT", DEFAULT_TIMEOUT)),
+        "max_bytes": int(os.environ.get("INVOICE_API_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024,
+    }
+    app.state.limiter = Limiter(int(os.environ.get("INVOICE_API_CONCURRENCY", workers)),
+                                int(os.environ.get("INVOICE_API_QUEUE", DEFAULT_QUEUE)))
+    try:
+        yield
+    finally:
+        shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route("/convert", convert, methods=["POST"]),
+        Route("/health", health),
+        Route("/metrics", metrics),
+    ],
+    lifespan=lifespan,
+)
@@ -9,21 +9,22 @@ def _():
     import marimo as mo
     import os
     import json
-    import zipfile
-    import pandas as pd
     import logging
     import urllib.parse
     from datetime import datetime
-    import glob
-    from io import BytesIO
-    import tempfile
     import traceback
-
-    # Importiere deine Datei
-    try:
-        from Invoice import Invoice
-    except ImportError:
-        Invoice = None
+    import uuid
+
+    # Importiere deine Dateien. Die Konvertierung selbst (Invoice, pandas, xlsxwriter)
+    # kommt erst über engine(): nach dem ersten Rendern im Hintergrund, spätestens
+    # beim ersten Upload (siehe warmup.py). Schlägt das fehl, meldet die
+    # Verarbeitung den Fehler.
+    from cache import result_cache
+    from formats import FORMAT_LABELS
+    from metrics import timing_table
+    from config_store import ConfigStore, diff_configs, save_config, table_to_config
+    from usk import RULES_KEY
+    from warmup import engine, loaded as engine_loaded, warm_up
 
     # --- KONFIGURATION ---
     CONFIG_DIR = "configs"
@@ -32,6 +33,9 @@ def _():
     # Sicherstellen, dass der Ordner existiert
     os.makedirs(CONFIG_DIR, exist_ok=True)
 
+    # Gesicherte Versionen der USK-Liste (Manifest in configs/manifest.json)
+    config_archiv = ConfigStore(CONFIG_DIR)
+
     # Standard-Fallback
     default_fallback = {
         "Allgemein": {"xSta": "05000.10000"},
@@ -49,6 +53,9 @@ def _():
     def flatten_data(data):
         flat_list = []
         for key, value in data.items():
+            if key == RULES_KEY:
+                # Schlüsselregeln sind keine Zuordnungen, sie bleiben beim Speichern erhalten
+                continue
             if isinstance(value, dict):
                 for sub_key, sub_val in value.items():
                     flat_list.append({"Gruppe": key, "Name": sub_key, "USK": sub_val})
@@ -57,24 +64,30 @@ def _():
         return flat_list
 
     return (
-        BytesIO,
         CONFIG_DIR,
         CURRENT_CONFIG_FILE,
-        Invoice,
+        FORMAT_LABELS,
+        RULES_KEY,
+        config_archiv,
         datetime,
+        diff_configs,
         default_fallback,
+        engine,
+        engine_loaded,
         flatten_data,
-        glob,
         json,
         load_json,
         logging,
         mo,
         os,
-        pd,
-        tempfile,
+        result_cache,
+        save_config,
+        table_to_config,
+        timing_table,
         traceback,
         urllib,
-        zipfile,
+        uuid,
+        warm_up,
     )
 
 
@@ -86,17 +99,22 @@ def _(mo):
 
     # Status: Für Nachrichten (Grün/Rot)
     get_status_msg, set_status_msg = mo.state("")
+
+    # Zähler: ein Stapel ist fertig angezeigt, der Fortschritts-Taktgeber wird abgebaut
+    get_stapel_fertig, set_stapel_fertig = mo.state(0)
     return (
+        get_stapel_fertig,
         get_status_msg,
         get_update_trigger,
+        set_stapel_fertig,
         set_status_msg,
         set_update_trigger,
     )
 
 
 @app.cell
-def _(CONFIG_DIR, CURRENT_CONFIG_FILE, datetime, default_fallback, flatten_data, get_saved_configs, get_update_trigger,
-      json, load_json, mo, os, set_status_msg, set_update_trigger):
+def _(CURRENT_CONFIG_FILE, config_archiv, datetime, default_fallback, get_saved_configs, get_update_trigger, load_json,
+      mo, os, save_config, set_status_msg, set_update_trigger):
     # --- CONTROL PANEL (Alles in einer Zelle für Sicherheit) ---
 
     # 1. Dropdown bauen
@@ -110,21 +128,18 @@ def _(CONFIG_DIR, CURRENT_CONFIG_FILE, datetime, default_fallback, flatten_data,
     # 2. Funktion: Backup Speichern
     def action_save():
         try:
-            os.makedirs(CONFIG_DIR, exist_ok=True)
             if os.path.exists(CURRENT_CONFIG_FILE):
                 data = load_json(CURRENT_CONFIG_FILE)
             else:
                 data = default_fallback
 
-            row_count = len(flatten_data(data))
-            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            fname = f"config_{timestamp}_{row_count}rows.json"
-            fpath = os.path.join(CONFIG_DIR, fname)
-
-            with open(fpath, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4)
-
-            set_status_msg(f"✅ Backup erstellt: {fname}")
+            # Gleicher Inhalt wie eine vorhandene Version -> keine neue Datei
+            version, created = config_archiv.snapshot(data)
+            if created:
+                set_status_msg(f"✅ Backup erstellt: {version['file']}")
+            else:
+                vom = datetime.fromisoformat(version["timestamp"]).strftime("%d.%m.%Y um %H:%M Uhr")
+                set_status_msg(f"ℹ️ Keine Änderung – identisch mit dem Backup vom {vom}")
             set_update_trigger(get_update_trigger() + 1)
         except Exception as e:
             set_status_msg(f"❌ Fehler beim Backup: {e}")
@@ -132,12 +147,11 @@ def _(CONFIG_DIR, CURRENT_CONFIG_FILE, datetime, default_fallback, flatten_data,
     # 3. Funktion: Backup Laden
     def action_load():
         selected_file = dd_backups.value
-        if selected_file and os.path.exists(selected_file):
+        if selected_file:
             try:
-                data = load_json(selected_file)
+                data = config_archiv.load(selected_file)
                 # Überschreiben der Current Config
-                with open(CURRENT_CONFIG_FILE, "w", encoding="utf-8") as f:
-                    json.dump(data, f, indent=4)
+                save_config(CURRENT_CONFIG_FILE, data)
 
                 set_status_msg(f"♻️ Erfolgreich geladen: {os.path.basename(selected_file)}")
                 # WICHTIG: Trigger feuern, damit Tabelle neu lädt
@@ -174,38 +188,72 @@ def _(CONFIG_DIR, CURRENT_CONFIG_FILE, datetime, default_fallback, flatten_data,
 
 
 @app.cell
-def _(CONFIG_DIR, datetime, get_update_trigger, glob, os):
+def _(config_archiv, datetime, get_update_trigger):
     # --- HELPER: CONFIGS SUCHEN ---
     def get_saved_configs():
         # Reagiert auf Updates
         _ = get_update_trigger()
 
-        files = glob.glob(os.path.join(CONFIG_DIR, "config_*.json"))
-        files.sort(key=os.path.getmtime, reverse=True)
-
+        # Kommt aus dem Manifest, die Versionen selbst werden nicht gelesen
         options = {}
-        for f in files:
-            try:
-                name = os.path.basename(f)
-                parts = name.replace("config_", "").replace(".json", "").split("_")
-                date_part = parts[0]
-                time_part = parts[1].replace("-", ":")
-                rows_part = parts[2].replace("rows", "")
-
-                dt_obj = datetime.strptime(f"{date_part} {time_part}", "%Y-%m-%d %H:%M:%S")
-                pretty_date = dt_obj.strftime("%d.%m.%Y um %H:%M Uhr")
-
-                label = f"📅 {pretty_date} ({rows_part} Einträge)"
-                options[label] = f
-            except:
-                continue
+        for version in config_archiv.versions():
+            pretty_date = datetime.fromisoformat(version["timestamp"]).strftime("%d.%m.%Y um %H:%M:%S Uhr")
+            label = f"📅 {pretty_date} ({version['rows']} Einträge)"
+            options[label] = version["file"]
         return options
 
     return (get_saved_configs,)
 
 
 @app.cell
-def _(CURRENT_CONFIG_FILE, control_panel, default_fallback, flatten_data, get_update_trigger, load_json, mo, os, pd):
+def _(control_panel, mo):
+    # --- KOPF & KONFIGURATIONS-PANEL ---
+    styles = mo.Html("""
+        <style>
+            #marimo-header button[aria-label='App menu'], header button[aria-label='App menu'] { display: none !important; }
+            .email-btn { display: inline-block; padding: 0.5rem 1rem; background-color: #fee2e2; color: #991b1b; border: 1px solid #fca5a5; border-radius: 0.375rem; text-decoration: none; font-weight: 600; }
+            a[download] { display: inline-block; width: 100%; text-align: center; background-color: #16a34a !important; color: white !important; padding: 12px 20px; font-weight: bold; border-radius: 8px; text-decoration: none; }
+        </style>
+    """)
+
+    mo.vstack([
+        styles,
+        mo.md("# 🧾 Invoice Parser Web"),
+        mo.md("**Info:** Die Tabelle speichert automatisch. Erstelle Backups bei größeren Änderungen."),
+        control_panel  # Das Panel aus der Zelle oben
+    ])
+    return (styles,)
+
+
+@app.cell
+def _(config_archiv, dd_backups, diff_configs, mo, table_to_config, tabelle_editor):
+    # --- VORSCHAU: WAS ÄNDERT "LADEN & AKTIVIEREN"? ---
+    vorschau = None
+    if dd_backups.value:
+        try:
+            aktuell = table_to_config(tabelle_editor.value, "Gruppe (Kategorie)", "Name / Beschreibung der Position",
+                                      "USK Nummer (Format 12345.12345)")
+            unterschiede = diff_configs(aktuell, config_archiv.load(dd_backups.value))
+            zeilen = ["| Änderung | Gruppe | Name | USK aktuell | USK nach dem Laden |", "|---|---|---|---|---|"]
+            zeilen += [f"| ➕ neu | {g} | {n} | | {u} |" for g, n, u in unterschiede["added"]]
+            zeilen += [f"| ➖ entfällt | {g} | {n} | {u} | |" for g, n, u in unterschiede["removed"]]
+            zeilen += [f"| ✏️ geändert | {g} | {n} | {alt} | {neu} |" for g, n, alt, neu in unterschiede["changed"]]
+            zusammenfassung = (f"{len(unterschiede['added'])} neu, {len(unterschiede['removed'])} entfallen, "
+                               f"{len(unterschiede['changed'])} geändert")
+            if len(zeilen) == 2:
+                vorschau = mo.callout(mo.md("**Vorschau:** Die gewählte Version entspricht der aktuellen Tabelle."),
+                                      kind="info")
+            else:
+                vorschau = mo.callout(mo.md(f"**Vorschau für 'Laden & Aktivieren':** {zusammenfassung}\n\n"
+                                            + "\n".join(zeilen)), kind="warn")
+        except Exception as e:
+            vorschau = mo.callout(mo.md(f"❌ Vergleich nicht möglich: {e}"), kind="danger")
+    vorschau
+    return aktuell, unterschiede, vorschau, zeilen, zusammenfassung
+
+
+@app.cell
+def _(CURRENT_CONFIG_FILE, FORMAT_LABELS, default_fallback, flatten_data, get_update_trigger, load_json, mo, os):
     # --- HAUPTANSICHT (TABELLE & UPLOAD) ---
 
     # 1. Trigger abonnieren (Damit Tabelle neu lädt nach Load-Klick)
@@ -217,16 +265,15 @@ def _(CURRENT_CONFIG_FILE, control_panel, default_fallback, flatten_data, get_up
     else:
         current_data = default_fallback
 
-    # 3. Tabelle bauen
-    df_raw = pd.DataFrame(flatten_data(current_data))
-    df_komplett = df_raw.rename(columns={
-        "Gruppe": "Gruppe (Kategorie)",
-        "Name": "Name / Beschreibung der Position",
-        "USK": "USK Nummer (Format 12345.12345)"
-    })
+    # 3. Tabelle bauen (Liste von Zeilen statt DataFrame: kein pandas zum Anzeigen)
+    tabelle_zeilen = [{
+        "Gruppe (Kategorie)": zeile["Gruppe"],
+        "Name / Beschreibung der Position": zeile["Name"],
+        "USK Nummer (Format 12345.12345)": zeile["USK"]
+    } for zeile in flatten_data(current_data)]
 
     tabelle_editor = mo.ui.data_editor(
-        data=df_komplett,
+        data=tabelle_zeilen,
         label="Tabelle bearbeiten (Änderungen werden in 'current_config' auto-gespeichert)",
     )
 
@@ -237,87 +284,81 @@ def _(CURRENT_CONFIG_FILE, control_panel, default_fallback, flatten_data, get_up
         filetypes=[".xml"]
     )
 
-    # 4. Styles
-    styles = mo.Html("""
-        <style>
-            #marimo-header button[aria-label='App menu'], header button[aria-label='App menu'] { display: none !important; }
-            .email-btn { display: inline-block; padding: 0.5rem 1rem; background-color: #fee2e2; color: #991b1b; border: 1px solid #fca5a5; border-radius: 0.375rem; text-decoration: none; font-weight: 600; }
-            a[download] { display: inline-block; width: 100%; text-align: center; background-color: #16a34a !important; color: white !important; padding: 12px 20px; font-weight: bold; border-radius: 8px; text-decoration: none; }
-        </style>
-    """)
+    format_auswahl = mo.ui.multiselect(
+        options=FORMAT_LABELS,
+        value=["Excel (.xlsx)"],
+        label="Ausgabeformate (bei CSV/JSON Lines/Parquet kommen die Kopfdaten in eine .info.json)"
+    )
+
+    # Eine Excel-Datei für den ganzen Upload statt einer pro XML im ZIP
+    gesamtdatei = mo.ui.checkbox(
+        label="Alle Dateien in einer Excel-Arbeitsmappe zusammenfassen (Quelldatei als eigene Spalte, "
+              "Ausgabeformate werden dann ignoriert)"
+    )
 
-    # 5. Layout anzeigen
+    # 4. Layout anzeigen (Kopf und Konfigurations-Panel stehen in der Zelle oben)
     mo.vstack([
-        styles,
-        mo.md("# 🧾 Invoice Parser Web"),
-        mo.md("**Info:** Die Tabelle speichert automatisch. Erstelle Backups bei größeren Änderungen."),
-        control_panel,  # Das Panel aus der Zelle oben
         tabelle_editor,
         mo.md("---"),
+        format_auswahl,
+        gesamtdatei,
         file_uploader
     ])
     return (
         current_data,
-        df_komplett,
-        df_raw,
         file_uploader,
-        styles,
+        format_auswahl,
+        gesamtdatei,
         tabelle_editor,
+        tabelle_zeilen,
     )
 
 
 @app.cell
-def _(BytesIO, CURRENT_CONFIG_FILE, Invoice, file_uploader, json, logging, mo, os, tabelle_editor, tempfile, traceback,
-      urllib, zipfile):
+def _(uuid):
+    # Kennung dieser Browser-Sitzung: ein neuer Upload bricht nur den eigenen Stapel ab
+    session_key = uuid.uuid4().hex
+    return (session_key,)
+
+
+@app.cell
+def _(CURRENT_CONFIG_FILE, RULES_KEY, current_data, engine, engine_loaded, file_uploader, format_auswahl,
+      gesamtdatei, json, logging, mo, result_cache, save_config, session_key, table_to_config, tabelle_editor,
+      tabelle_zeilen, traceback):
     # --- LOGIK & VERARBEITUNG ---
     ergebnis_anzeige = []
+    job = None
+    log_messages = []
+    usk_json_string = ""
 
     try:
-        if Invoice is None:
-            raise Exception("Die Klasse 'Invoice' (Invoice.py) wurde nicht gefunden.")
-
-        processed_files = []
-        log_messages = []
-        problematische_dateien = []
-
         # 1. DATEN HOLEN & CHECK
-        df_neu = tabelle_editor.value
+        zeilen_neu = tabelle_editor.value
 
-        # Spalten-Check
+        # Spalten-Check (Liste von Zeilen; eine leere Tabelle hat keine Spalten)
         erwartete_spalten = ["Gruppe (Kategorie)", "Name / Beschreibung der Position",
                              "USK Nummer (Format 12345.12345)"]
-        fehlende_spalten = [col for col in erwartete_spalten if col not in df_neu.columns]
+        vorhandene_spalten = zeilen_neu[0].keys() if zeilen_neu else erwartete_spalten
+        fehlende_spalten = [col for col in erwartete_spalten if col not in vorhandene_spalten]
 
         if fehlende_spalten:
             raise Exception(
                 f"Spaltenstruktur beschädigt! Folgende Spalten fehlen: {', '.join(fehlende_spalten)}. Bitte klicke oben auf 'Laden', um die Tabelle zu reparieren.")
 
-        usk_struktur = {}
-
-        for index, row in df_neu.iterrows():
-            gruppe = str(row["Gruppe (Kategorie)"]).strip()
-            name = str(row["Name / Beschreibung der Position"]).strip()
-            usk = str(row["USK Nummer (Format 12345.12345)"]).strip()
-
-            if not name or not usk: continue
-            if not gruppe: gruppe = "BASIS"
-
-            if gruppe == "BASIS":
-                usk_struktur[name] = usk
-            else:
-                if gruppe not in usk_struktur: usk_struktur[gruppe] = {}
-                usk_struktur[gruppe][name] = usk
+        if zeilen_neu == tabelle_zeilen:
+            # Unverändert geladen: nichts umzuwandeln oder zu speichern (und kein
+            # pandas beim ersten Rendern)
+            usk_struktur = current_data
+        else:
+            usk_struktur = table_to_config(zeilen_neu, *erwartete_spalten, rules=current_data.get(RULES_KEY))
 
+            # 2. AUTO-SAVE (nur bei geänderter Zuordnung, atomar über Temp-Datei)
+            try:
+                save_config(CURRENT_CONFIG_FILE, usk_struktur)
+            except Exception as e:
+                log_messages.append(f"❌ Warnung: Auto-Save fehlgeschlagen: {e}")
         usk_json_string = json.dumps(usk_struktur, indent=4)
 
-        # 2. AUTO-SAVE
-        try:
-            os.makedirs(os.path.dirname(CURRENT_CONFIG_FILE), exist_ok=True)
-            with open(CURRENT_CONFIG_FILE, "w", encoding="utf-8") as f_write:
-                json.dump(usk_struktur, f_write, indent=4)
-        except Exception as e:
-            log_messages.append(f"❌ Warnung: Auto-Save fehlgeschlagen: {e}")
-
         # 3. DATEI-VERARBEITUNG
         if file_uploader.value:
             logger = logging.getLogger("Invoice Parser")
@@ -325,52 +366,136 @@ def _(BytesIO, CURRENT_CONFIG_FILE, Invoice, file_uploader, json, logging, mo, o
             logger.addHandler(logging.NullHandler())
             logger.propagate = False
 
-            with tempfile.TemporaryDirectory() as temp_dir:
-                src_path = os.path.join(temp_dir, "input") + os.sep
-                dest_path = os.path.join(temp_dir, "output") + os.sep
-                os.makedirs(src_path, exist_ok=True)
-                os.makedirs(dest_path, exist_ok=True)
-
-                for file_obj in file_uploader.value:
-                    file_path = os.path.join(src_path, file_obj.name)
-                    with open(file_path, "wb") as f_up:
-                        f_up.write(file_obj.contents)
-
-                fake_config = {
-                    "files": {"source_path": src_path, "destination_path": dest_path},
-                    "usk": {"usk_liste": usk_json_string}
-                }
-
-                files_in_temp = os.listdir(src_path)
-                for filename in files_in_temp:
-                    try:
-                        invoice_processor = Invoice(filename, fake_config)
-                        created_file_path = invoice_processor.create_file()
-
-                        if os.path.exists(created_file_path):
-                            with open(created_file_path, "rb") as f_res:
-                                processed_files.append({
-                                    "name": os.path.basename(created_file_path),
-                                    "content": f_res.read()
-                                })
-                            log_messages.append(f"✅ {filename} erfolgreich verarbeitet.")
-                        else:
-                            log_messages.append(f"⚠️ {filename}: Excel wurde nicht erstellt.")
-                            problematische_dateien.append(filename)
-                    except Exception as e:
-                        err_msg = str(e)
-                        log_messages.append(f"❌ Fehler bei {filename}: {err_msg}")
-                        problematische_dateien.append(filename)
-
-        # 4. OUTPUT
-        fehler_text = "\n".join([msg for msg in log_messages if "❌" in msg or "⚠️" in msg])
-        if not fehler_text: fehler_text = "Keine offensichtlichen Fehler im Protokoll."
-
-        dateien_hinweis = ""
-        if problematische_dateien:
-            dateien_hinweis = f"Dateien: {', '.join(problematische_dateien)}"
-
-        email_body = f"""Hallo Hotline-Team,
+            # Uploads werden direkt aus dem Speicher gelesen und im Hintergrund
+            # parallel in einem Prozess-Pool konvertiert (Anzahl über
+            # INVOICE_PARSER_WORKERS, begrenzt durch CPU- und Speicherlimit des
+            # Containers). Fehler einzelner Dateien bleiben isoliert, unveränderte
+            # Dateien mit unveränderter USK-Liste kommen aus dem Cache. Ein neuer
+            # Upload bricht einen noch laufenden Stapel ab.
+            ausgabeformate = format_auswahl.value or ["xlsx"]
+            job = engine().start_job(
+                session_key,
+                [(file_obj.name, file_obj.contents) for file_obj in file_uploader.value],
+                usk_struktur,
+                cache=result_cache,
+                formats=ausgabeformate,
+                consolidated=gesamtdatei.value
+            )
+        elif engine_loaded():
+            # Ohne Upload wird die Konvertierung gar nicht erst geladen
+            engine().cancel_job(session_key)
+
+    except Exception as e_critical:
+        err_trace = traceback.format_exc()
+        ergebnis_anzeige.append(
+            mo.callout(mo.md(f"## 🔥 KRITISCHER FEHLER\n`{str(e_critical)}`\n\n```\n{err_trace}\n```"), kind="danger"))
+
+    mo.vstack(ergebnis_anzeige)
+    return (
+        ausgabeformate,
+        ergebnis_anzeige,
+        err_trace,
+        erwartete_spalten,
+        fehlende_spalten,
+        job,
+        log_messages,
+        logger,
+        usk_json_string,
+        usk_struktur,
+        vorhandene_spalten,
+        zeilen_neu,
+    )
+
+
+@app.cell
+def _(get_stapel_fertig, job, mo):
+    # --- TAKTGEBER ---
+    # Nur solange ein Stapel wartet oder läuft; ist er fertig angezeigt, läuft diese
+    # Zelle über get_stapel_fertig erneut und baut den Taktgeber ab
+    _ = get_stapel_fertig()
+    fortschritt_ticker = None
+    if job is not None and not job.done:
+        fortschritt_ticker = mo.ui.refresh(options=["1s", "5s"], default_interval="1s",
+                                           label="Fortschritt aktualisieren")
+    fortschritt_ticker
+    return (fortschritt_ticker,)
+
+
+@app.cell
+def _(engine, fortschritt_ticker, job, log_messages, mo, set_stapel_fertig, timing_table, urllib,
+      usk_json_string):
+    # --- FORTSCHRITT & ERGEBNIS ---
+    # Läuft bei jedem Tick von fortschritt_ticker erneut; ein abgeschlossener
+    # Stapel wird nur einmal aufgebaut (job.ui)
+    _ = fortschritt_ticker.value if fortschritt_ticker is not None else None
+    ergebnis = []
+    # Status-Konstanten aus jobs; mit einem Job ist die Konvertierung schon geladen
+    zustand = engine() if job is not None else None
+
+    if job is not None and "anzeige" in job.ui:
+        ergebnis = job.ui["anzeige"]
+    elif job is not None or log_messages:
+        stand = job.snapshot() if job is not None else {"log": []}
+        protokoll = log_messages + stand["log"]
+
+        if job is not None and job.status == zustand.WAITING and stand["queue_position"] is not None:
+            # Andere Sitzungen belegen gerade das Speicherbudget (siehe scheduler.py)
+            speicher = stand["scheduler"]
+            ergebnis.append(mo.callout(mo.vstack([
+                mo.md(f"### 🕒 In der Warteschlange: Platz {stand['queue_position']} von {speicher['waiting']}"),
+                mo.md(f"Dieser Upload braucht etwa {stand['memory_mb']} MB, belegt sind {speicher['used_mb']} von "
+                      f"{speicher['budget_mb']} MB ({speicher['running']} Konvertierungen laufen). Die "
+                      f"Konvertierung startet automatisch."),
+            ]), kind="neutral"))
+        elif job is not None and job.status in (zustand.WAITING, zustand.CHECKING):
+            ergebnis.append(mo.callout(mo.vstack([
+                mo.md(f"### 🔎 Vorabprüfung der USK-Zuordnungen ({stand['files_total']} Dateien) ..."),
+                mo.Html("<progress style='width: 100%'></progress>")
+            ]), kind="info"))
+        elif job is not None and not job.done:
+            dateien_text = f"{stand['files_done']}/{stand['files_total']} Dateien"
+            if stand["records_total"] is None:
+                fortschritt_html = "<progress style='width: 100%'></progress>"
+                datensaetze_text = "Datensätze werden gezählt ..."
+            else:
+                fortschritt_html = (f"<progress style='width: 100%' value='{stand['records_done']}' "
+                                    f"max='{max(stand['records_total'], 1)}'></progress>")
+                datensaetze_text = f"{stand['records_done']}/{stand['records_total']} Datensätze"
+            ergebnis.append(mo.callout(mo.vstack([
+                mo.md(f"### ⏳ Konvertierung läuft ... {dateien_text}, {datensaetze_text}"),
+                mo.Html(fortschritt_html)
+            ]), kind="info"))
+
+        if job is not None and job.error:
+            ergebnis.append(mo.callout(mo.md(f"## 🔥 KRITISCHER FEHLER\n```\n{job.error}\n```"), kind="danger"))
+
+        if job is not None and job.status == zustand.BLOCKED:
+            # Genau die Zeilen, die in der USK-Tabelle fehlen (USK-Nummer noch eintragen)
+            fehlende_zeilen = ["| Gruppe (Kategorie) | Name / Beschreibung der Position | "
+                               "USK Nummer (Format 12345.12345) | Vorkommen | Dateien |",
+                               "|---|---|---|---|---|"]
+            for eintrag in job.preflight["missing"]:
+                fehlende_zeilen.append(
+                    f"| {eintrag['group']} | {eintrag['name'] if eintrag['name'] else '(leer)'} | *eintragen* | "
+                    f"{eintrag['count']} | {', '.join(eintrag['files'])} |")
+            ergebnis.append(mo.callout(mo.vstack([
+                mo.md(f"### ✋ {len(job.preflight['missing'])} USK-Zuordnungen fehlen"),
+                mo.md("Bitte diese Zeilen in der Tabelle oben ergänzen. Danach startet die Konvertierung automatisch "
+                      "neu.\n\n" + "\n".join(fehlende_zeilen))
+            ]), kind="warn"))
+
+        if protokoll:
+            ergebnis.append(mo.md("**Verarbeitungsprotokoll:**\n" + "\n".join([f"* {msg}" for msg in protokoll])))
+
+        if job is None or job.done:
+            fehler_text = "\n".join([msg for msg in protokoll if "❌" in msg or "⚠️" in msg])
+            if not fehler_text: fehler_text = "Keine offensichtlichen Fehler im Protokoll."
+
+            dateien_hinweis = ""
+            if job is not None and job.problem_files:
+                dateien_hinweis = f"Dateien: {', '.join(job.problem_files)}"
+
+            email_body = f"""Hallo Hotline-Team,
 
 ich habe Probleme mit dem Invoice Parser.
 
@@ -389,93 +514,83 @@ ich habe Probleme mit dem Invoice Parser.
 
 Viele Grüße
 """
-        params = {"subject": "Invoice Parser Web Anfrage", "body": email_body}
-        query_string = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
-        mailto_link = f"mailto:hotline@worms.de?{query_string}"
-
-        email_button = mo.Html(f"""
-            <div style="margin-top: 20px; text-align: right;">
-                <a href="{mailto_link}" class="email-btn">📧 Fehler melden (Email öffnen)</a>
-            </div>
-        """)
-
-        if processed_files or log_messages:
-            ergebnis_anzeige.append(
-                mo.md("**Verarbeitungsprotokoll:**\n" + "\n".join([f"* {msg}" for msg in log_messages])))
-            ergebnis_anzeige.append(email_button)
-
-            if processed_files:
-                anzahl_erfolg = len(processed_files)
-                anzahl_gesamt = len(file_uploader.value)
-                status_text = f"{anzahl_erfolg}/{anzahl_gesamt} Dateien wurden erfolgreich konvertiert."
-
-                if len(processed_files) == 1:
-                    dl_obj = mo.download(
-                        processed_files[0]["content"],
-                        filename=processed_files[0]["name"],
-                        label=f"Download {processed_files[0]['name']}"
-                    )
+            params = {"subject": "Invoice Parser Web Anfrage", "body": email_body}
+            query_string = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+            mailto_link = f"mailto:hotline@worms.de?{query_string}"
+
+            email_button = mo.Html(f"""
+                <div style="margin-top: 20px; text-align: right;">
+                    <a href="{mailto_link}" class="email-btn">📧 Fehler melden (Email öffnen)</a>
+                </div>
+            """)
+
+            if job is not None and job.status == zustand.DONE:
+                ergebnis.append(mo.accordion({
+                    "⏱️ Zeiten pro Datei": mo.md(timing_table(job.results, job.batch_metrics))
+                }))
+            ergebnis.append(email_button)
+
+            if job is not None and job.status == zustand.DONE and job.download_name is not None:
+                anzahl_erfolg = sum(1 for result in job.results if not result["error"] and result["outputs"])
+                status_text = f"{anzahl_erfolg}/{len(job.results)} Dateien wurden erfolgreich konvertiert."
+                download_name = job.download_name
+                if job.single_output is not None:
+                    download_label = f"Download {download_name}"
                 else:
-                    zip_buffer = BytesIO()
-                    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                        for p_file in processed_files:
-                            zip_file.writestr(p_file["name"], p_file["content"])
-                    dl_obj = mo.download(zip_buffer.getvalue(), filename="rechnungen_export.zip",
-                                         label=f"Download alle ({len(processed_files)} Dateien) als ZIP")
-
-                ergebnis_anzeige.append(
-                    mo.callout(mo.vstack([mo.md(f"### 🎉 Fertig!\n**{status_text}**"), dl_obj]), kind="success"))
-
-    except Exception as e_critical:
-        err_trace = traceback.format_exc()
-        ergebnis_anzeige.append(
-            mo.callout(mo.md(f"## 🔥 KRITISCHER FEHLER\n`{str(e_critical)}`\n\n```\n{err_trace}\n```"), kind="danger"))
-
-    mo.vstack(ergebnis_anzeige)
+                    download_label = f"Download alle ({job.output_count} Dateien) als ZIP"
+                # Das Archiv wird erst hier aus dem Temp-Speicher gelesen
+                dl_obj = mo.download(job.download_content(), filename=download_name, label=download_label)
+                downloads = [dl_obj]
+                if job.summary_output is not None:
+                    abgleich_obj = mo.download(job.summary_output["content"], filename=job.summary_output["name"],
+                                               label=f"Download {job.summary_output['name']}")
+                    downloads.append(abgleich_obj)
+                ergebnis.append(
+                    mo.callout(mo.vstack([mo.md(f"### 🎉 Fertig!\n**{status_text}**"), *downloads]), kind="success"))
+
+            if job is not None:
+                job.ui["anzeige"] = ergebnis
+                set_stapel_fertig(lambda anzahl: anzahl + 1)
+
+    mo.vstack(ergebnis)
     return (
+        abgleich_obj,
+        anzahl_erfolg,
         dateien_hinweis,
-        dest_path,
+        dateien_text,
+        datensaetze_text,
         dl_obj,
-        df_neu,
+        download_label,
+        download_name,
+        downloads,
         email_body,
         email_button,
-        ergebnis_anzeige,
-        err_msg,
-        err_trace,
-        erwartete_spalten,
-        fake_config,
-        fehlende_spalten,
+        ergebnis,
+        eintrag,
+        fehlende_zeilen,
         fehler_text,
-        file_obj,
-        file_path,
-        filename,
-        files_in_temp,
-        f_up,
-        fake_config,
-        invoice_processor,
-        created_file_path,
-        f_res,
-        f_write,
-        gruppe,
-        index,
-        log_messages,
-        logger,
+        fortschritt_html,
         mailto_link,
-        name,
         params,
-        problematische_dateien,
-        processed_files,
+        protokoll,
         query_string,
-        row,
-        src_path,
-        temp_dir,
-        usk,
-        usk_json_string,
-        usk_struktur,
-        zip_buffer,
-        zip_file,
+        speicher,
+        stand,
+        status_text,
+        zustand,
     )
 
 
+@app.cell
+def _(ergebnis, warm_up):
+    # --- VORLADEN ---
+    # Nach dem ersten Rendern (hängt von ergebnis ab, läuft also zuletzt): die
+    # Konvertierung und den Worker-Pool im Hintergrund laden, damit der erste
+    # Upload nicht darauf warten muss
+    _ = ergebnis
+    warm_up()
+    return
+
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
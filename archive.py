@@ -0,0 +1,50 @@
+import os
+import tempfile
+import threading
+import zipfile
+
+# XLSX (selbst ein ZIP) und Parquet sind bereits komprimiert; ein zweites Deflate
+# kostet nur CPU. Alles andere (CSV, JSON Lines, .info.json) wird komprimiert.
+STORED_SUFFIXES = (".xlsx", ".parquet")
+# Bis zu dieser Größe bleibt das Archiv im Speicher, darüber in einer Temp-Datei
+DEFAULT_SPOOL_MB = 64
+
+
+def compress_type(name):
+    return zipfile.ZIP_STORED if name.lower().endswith(STORED_SUFFIXES) else zipfile.ZIP_DEFLATED
+
+
+class ArchiveBuilder:
+    # Nimmt die Ausgaben auf, sobald eine Datei fertig ist; read() liefert das
+    # fertige ZIP für den Download
+
+    def __init__(self, spool_bytes=None):
+        if spool_bytes is None:
+            spool_bytes = int(os.environ.get("INVOICE_PARSER_SPOOL_MB", DEFAULT_SPOOL_MB)) * 1024 * 1024
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self.zip_file = zipfile.ZipFile(self.file, "w")
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, content):
+        with self.lock:
+            self.zip_file.writestr(name, content, compress_type=compress_type(name))
+            self.count += 1
+
+    def close(self):
+        # Schreibt das Inhaltsverzeichnis; danach können keine Einträge mehr dazukommen
+        with self.lock:
+            if self.zip_file is not None:
+                self.zip_file.close()
+                self.zip_file = None
+
+    def read(self):
+        self.close()
+        with self.lock:
+            self.file.seek(0)
+            return self.file.read()
+
+    def discard(self):
+        with self.lock:
+            self.zip_file = None
+            self.file.close()
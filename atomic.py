@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+# mkstemp legt Dateien mit 0600 an, os.replace übernimmt das. Ausgaben und USK-Liste
+# sollen wie bei open() der umask folgen (Freigaben, Bind-Mount, Host-Benutzer).
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def write_atomic(path, content):
+    # Eindeutige Temp-Datei im Zielordner (mehrere Sitzungen, Jobs oder Worker
+    # können gleichzeitig schreiben), dann umbenennen: ein Abbruch oder Neustart
+    # mitten im Schreiben hinterlässt nie eine halbe Datei
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(content)
+            os.fchmod(temp_file.fileno(), FILE_MODE)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,160 @@
+# Stapelbetrieb ohne Browser: konvertiert alle XML-Dateien eines Ordners und
+# verschiebt sie danach ins Archiv (Invoice.cleanup).
+#
+#   python batch.py --source /share/eingang/ --dest /share/ausgang/
+#   python batch.py --source /share/eingang/ --dest /share/ausgang/ --watch --interval 60
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+from cache import config_hash
+from conversion import DEFAULT_FORMATS, convert_path, get_executor, shutdown, worker_count
+from formats import FORMATS
+from ledger import check_files, get_ledger
+from reconcile import mismatch_message
+
+logger = logging.getLogger("Invoice Parser")
+
+_stop = False
+
+
+def _request_stop(signum, frame):
+    global _stop
+    _stop = True
+    logger.info("Beende nach dem laufenden Durchgang ...")
+
+
+def load_usk_config(path):
+    with open(path, "r", encoding="utf-8") as fd:
+        return json.load(fd)
+
+
+def list_xml(source_path):
+    # Nur fertige *.xml direkt im Quellordner; Archiv/ und Temp-Dateien bleiben außen vor
+    names = []
+    for entry in os.scandir(source_path):
+        if entry.is_file() and entry.name.lower().endswith(".xml") and not entry.name.startswith("."):
+            stat = entry.stat()
+            names.append((entry.name, (stat.st_size, stat.st_mtime)))
+    return sorted(names)
+
+
+def _read_files(source_path, files):
+    for name in files:
+        with open(os.path.join(source_path, name), "rb") as fd:
+            yield name, fd.read()
+
+
+def check_ledger(files, args):
+    # Doppelte Dateien und überschneidende Zeiträume melden (nur Kopfdaten); die
+    # Dateien werden trotzdem konvertiert
+    try:
+        ledger = get_ledger()
+        checks = check_files(ledger, _read_files(args.source, files))
+    except Exception as e:
+        logger.warning("⚠️ Dateiverzeichnis nicht verfügbar: %s", e)
+        return None, {}
+    for check in checks:
+        for message in check["messages"]:
+            logger.warning(message)
+    return ledger, {check["source"]: check for check in checks}
+
+
+def run_once(files, args, usk_config):
+    key = config_hash(usk_config)
+    ledger, checks = check_ledger(files, args)
+    workers = worker_count(args.workers)
+    jobs = [(name, args.source, args.dest, usk_config, key, args.formats, not args.no_archive) for name in files]
+    if workers <= 1 or len(jobs) <= 1:
+        results = [convert_path(*job) for job in jobs]
+    else:
+        executor = get_executor(workers)
+        futures = [executor.submit(convert_path, *job) for job in jobs]
+        results = []
+        for name, future in zip(files, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"source": name, "outputs": [], "error": str(e)})
+    for result in results:
+        if result["error"]:
+            logger.error("❌ Fehler bei %s: %s", result["source"], result["error"])
+        else:
+            logger.info("✅ %s -> %s", result["source"], ", ".join(os.path.basename(p) for p in result["outputs"]))
+            mismatch = mismatch_message(result["source"], result.get("reconciliation"))
+            if mismatch:
+                logger.warning(mismatch)
+            check = checks.get(result["source"])
+            if ledger is not None and check is not None and check["header"] is not None:
+                ledger.record(check["hash"], check["header"], result["source"], key)
+    return results
+
+
+def watch(args):
+    # Eine Datei wird erst angefasst, wenn Größe und Änderungszeit zwischen zwei
+    # Durchläufen gleich geblieben sind (Upload auf die Freigabe abgeschlossen).
+    # Bereits konvertierte (mit --no-archive) und fehlgeschlagene Dateien werden
+    # erst wieder angefasst, wenn sie sich ändern.
+    # Nach einem Neustart liegen unfertige Dateien noch im Quellordner und werden
+    # erneut verarbeitet; Ausgaben werden atomar ersetzt.
+    seen = {}
+    # Name -> (Größe, Änderungszeit) beim letzten Versuch
+    handled = {}
+    while not _stop:
+        try:
+            current = dict(list_xml(args.source))
+            ready = [name for name, state in sorted(current.items())
+                     if seen.get(name) == state and handled.get(name) != state
+                     and time.time() - state[1] >= args.settle]
+            seen = current
+            handled = {name: state for name, state in handled.items() if name in current}
+            if ready:
+                for result in run_once(ready, args, load_usk_config(args.config)):
+                    handled[result["source"]] = current[result["source"]]
+        except Exception as e:
+            logger.error("❌ Durchlauf fehlgeschlagen: %s", e)
+        for _ in range(int(args.interval * 10)):
+            if _stop:
+                break
+            time.sleep(0.1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="epay21-XML-Dateien ohne Weboberfläche konvertieren")
+    parser.add_argument("--source", required=True, help="Ordner mit den XML-Dateien")
+    parser.add_argument("--dest", required=True, help="Zielordner für die Ausgaben")
+    parser.add_argument("--config", default=os.path.join("configs", "current_config.json"),
+                        help="USK-Liste (Standard: configs/current_config.json)")
+    parser.add_argument("--formats", nargs="+", choices=sorted(FORMATS), default=list(DEFAULT_FORMATS))
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Anzahl Worker-Prozesse (Standard: INVOICE_PARSER_WORKERS bzw. 4)")
+    parser.add_argument("--watch", action="store_true", help="Quellordner dauerhaft überwachen")
+    parser.add_argument("--interval", type=float, default=30, help="Sekunden zwischen zwei Durchläufen")
+    parser.add_argument("--settle", type=float, default=5,
+                        help="Mindestalter einer Datei in Sekunden, bevor sie verarbeitet wird")
+    parser.add_argument("--no-archive", action="store_true", help="XML nach der Konvertierung nicht verschieben")
+    args = parser.parse_args(argv)
+    args.source = os.path.join(args.source, "")
+    args.dest = os.path.join(args.dest, "")
+    args.formats = tuple(args.formats)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    os.makedirs(args.dest, exist_ok=True)
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+    try:
+        if args.watch:
+            watch(args)
+            return 0
+        results = run_once([name for name, _ in list_xml(args.source)], args, load_usk_config(args.config))
+        return 1 if any(result["error"] for result in results) else 0
+    finally:
+        shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
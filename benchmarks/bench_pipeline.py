@@ -0,0 +1,152 @@
+# Benchmark der Konvertierungskette mit synthetischen Daten (läuft komplett offline)
+#
+#   python benchmarks/bench_pipeline.py
+#   python benchmarks/bench_pipeline.py --records 500000 --files 400 --records-per-file 2000
+#   python benchmarks/bench_pipeline.py --json ergebnis.json
+#
+# Szenarien: eine große Datei und viele kleine Dateien. Stufen:
+#   parse   - RecordEntry-Elemente streamen (iter_records)
+#   usk     - zusätzliche Zeit für die USK-Auflösung
+#   write   - zusätzliche Zeit für das Schreiben der Ausgaben (Invoice.export)
+#   zip     - ZIP-Archiv wie beim Download in app.py (ArchiveBuilder)
+#   gesamt  - convert_batch (Worker-Pool) + ZIP, wie die Web-Oberfläche
+# Jede Stufe läuft in einem eigenen Prozess; Peak RSS ist der Höchstwert dieses
+# Prozesses (bei "gesamt" ohne die Worker-Prozesse).
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ("parse", "usk", "write", "zip", "gesamt")
+CONFIG_FILE = os.path.join(ROOT, "configs", "current_config.json")
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_stage(directory, stage, formats):
+    from Invoice import Invoice, iter_records
+    from archive import ArchiveBuilder
+    from conversion import convert_batch, shutdown
+    from usk import USKResolver
+
+    with open(CONFIG_FILE, "r", encoding="utf-8") as fd:
+        usk_config = json.load(fd)
+    files = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as fd:
+            files.append((name, fd.read()))
+    resolver = USKResolver(usk_config)
+
+    def parse():
+        for _, data in files:
+            for _ in iter_records(data):
+                pass
+
+    def resolve():
+        for _, data in files:
+            for record in iter_records(data):
+                resolver.resolve(record.epay21App, record.Purpose)
+
+    outputs = []
+
+    def export():
+        for name, data in files:
+            outputs.extend(Invoice(name, {}, resolver=resolver, source=data).export(formats))
+
+    def pack():
+        archive = ArchiveBuilder()
+        for output in outputs:
+            archive.add(output["name"], output["content"])
+        archive.close()
+        archive.discard()
+
+    def batch():
+        results = convert_batch(files, usk_config, formats=formats)
+        outputs.extend(output for result in results for output in result["outputs"])
+        pack()
+
+    if stage == "parse":
+        seconds = _timed(parse)
+    elif stage == "usk":
+        seconds = _timed(resolve) - _timed(parse)
+    elif stage == "write":
+        base = _timed(resolve)
+        seconds = _timed(export) - base
+    elif stage == "zip":
+        export()
+        seconds = _timed(pack)
+    else:
+        seconds = _timed(batch)
+        shutdown()
+    print(json.dumps({
+        "seconds": seconds,
+        "bytes_in": sum(len(data) for _, data in files),
+        "bytes_out": sum(len(output["content"]) for output in outputs),
+    }))
+
+
+def measure(directory, stage, formats):
+    proc = subprocess.Popen([sys.executable, __file__, "--stage", directory, stage, ",".join(formats)],
+                            stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    if status != 0:
+        raise RuntimeError(f"Stufe {stage} fehlgeschlagen")
+    result = json.loads(output)
+    # ru_maxrss ist unter Linux in KiB
+    result["peak_rss_mb"] = usage.ru_maxrss / 1024
+    return result
+
+
+def main(argv=None):
+    from generate import write_epay21
+
+    parser = argparse.ArgumentParser(description="Benchmark der Konvertierungskette")
+    parser.add_argument("--records", type=int, default=200000, help="Datensätze der großen Datei")
+    parser.add_argument("--files", type=int, default=200, help="Anzahl kleiner Dateien")
+    parser.add_argument("--records-per-file", type=int, default=1000)
+    parser.add_argument("--formats", nargs="+", default=["xlsx"])
+    parser.add_argument("--json", help="Ergebnisse zusätzlich als JSON speichern")
+    args = parser.parse_args(argv)
+
+    scenarios = {
+        f"1 x {args.records}": [args.records],
+        f"{args.files} x {args.records_per_file}": [args.records_per_file] * args.files,
+    }
+    report = []
+    print(f"{'Szenario':>16} {'Stufe':>7} {'Zeit (s)':>9} {'Datensätze/s':>13} {'Peak RSS (MiB)':>15}")
+    for scenario, sizes in scenarios.items():
+        with tempfile.TemporaryDirectory() as directory:
+            for index, records in enumerate(sizes):
+                name = f"datei_{index:05d}.xml"
+                with open(os.path.join(directory, name), "w", encoding="utf-8") as fd:
+                    write_epay21(fd, records, seed=index, file_name=name)
+            total = sum(sizes)
+            for stage in STAGES:
+                result = measure(directory, stage, args.formats)
+                rate = total / result["seconds"] if result["seconds"] > 0 else float("inf")
+                result.update(scenario=scenario, stage=stage, records=total, records_per_second=rate)
+                report.append(result)
+                print(f"{scenario:>16} {stage:>7} {result['seconds']:>9.2f} {rate:>13.0f} "
+                      f"{result['peak_rss_mb']:>15.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, indent=4)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--stage"]:
+        run_stage(sys.argv[2], sys.argv[3], tuple(sys.argv[4].split(",")))
+    else:
+        main()
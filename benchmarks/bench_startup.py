@@ -0,0 +1,141 @@
+# Startzeit der Weboberfläche: Import und erstes Rendern von app.py, danach der
+# erste Upload mit und ohne Vorladen (warmup.py)
+#
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --runs 10 --records 2000 --export
+#   python benchmarks/bench_startup.py --json ergebnis.json
+#
+# Jeder Lauf ist ein frischer Prozess (kalter Import). Messwerte (Median über --runs):
+#   marimo    - import marimo
+#   app       - import app (Zellen registrieren)
+#   render    - app.run(): alle Zellen einmal, wie beim ersten Aufruf der Seite
+#   engine    - engine(): Konvertierung nachladen (jobs, Invoice, pandas, ...)
+#   upload    - erster Upload ohne Vorladen (INVOICE_PARSER_WARMUP=0), inkl. engine
+#   vorgeladen - erster Upload, nachdem warm_up() fertig ist
+# --export misst zusätzlich "marimo export html" als Ende-zu-Ende-Zeit.
+# Endet mit Status 1, wenn nach dem ersten Rendern schon ein schweres Modul geladen ist.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("pandas", "numpy", "pyarrow", "xlsxwriter", "xmltodict", "Invoice", "jobs", "conversion")
+CONFIG_FILE = os.path.join(ROOT, "configs", "current_config.json")
+
+
+def _wait(job):
+    from jobs import DONE
+
+    while not job.done:
+        time.sleep(0.01)
+    if job.status != DONE:
+        raise RuntimeError(f"Upload fehlgeschlagen: {job.status} {job.error}")
+
+
+def run_once(records, warm):
+    # Läuft im Kindprozess, Ausgabe als JSON auf stdout
+    from generate import generate_bytes
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    files = [("start.xml", generate_bytes(records, seed=1, file_name="start.xml"))]
+    with open(CONFIG_FILE, "r", encoding="utf-8") as fd:
+        usk_config = json.load(fd)
+    result = {}
+
+    start = time.perf_counter()
+    import marimo  # noqa: F401
+    result["marimo"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from app import app
+    result["app"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app.run()
+    result["render"] = time.perf_counter() - start
+    result["heavy"] = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    import warmup
+
+    if warm:
+        warmup.warm_up().join()
+        start = time.perf_counter()
+        engine = warmup.engine()
+        _wait(engine.start_job("bench", files, usk_config))
+        result["vorgeladen"] = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        engine = warmup.engine()
+        result["engine"] = time.perf_counter() - start
+        _wait(engine.start_job("bench", files, usk_config))
+        result["upload"] = time.perf_counter() - start
+
+    from conversion import shutdown
+
+    shutdown()
+    print(json.dumps(result))
+
+
+def measure(records, warm, ledger):
+    env = dict(os.environ, INVOICE_PARSER_WARMUP="1" if warm else "0", INVOICE_PARSER_LEDGER=ledger)
+    output = subprocess.run([sys.executable, __file__, "--run", str(records), "1" if warm else "0"], env=env,
+                            stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def measure_export(directory):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "marimo", "export", "html", os.path.join(ROOT, "app.py"), "-o",
+                    os.path.join(directory, "app.html")], cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, env=dict(os.environ, INVOICE_PARSER_WARMUP="0"))
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Startzeit und erster Upload")
+    parser.add_argument("--runs", type=int, default=5, help="frische Prozesse pro Variante")
+    parser.add_argument("--records", type=int, default=1000, help="Datensätze des ersten Uploads")
+    parser.add_argument("--export", action="store_true", help="zusätzlich marimo export html messen")
+    parser.add_argument("--json", help="Ergebnis zusätzlich als JSON speichern")
+    args = parser.parse_args(argv)
+
+    samples = {}
+    heavy = set()
+    with tempfile.TemporaryDirectory() as directory:
+        for number in range(args.runs):
+            for warm in (False, True):
+                # Eigenes Dateiverzeichnis pro Lauf, sonst wäre der Upload ab dem zweiten Lauf ein Duplikat
+                result = measure(args.records, warm, os.path.join(directory, f"ledger_{number}_{int(warm)}.sqlite3"))
+                heavy.update(result.pop("heavy"))
+                for key, seconds in result.items():
+                    samples.setdefault(key, []).append(seconds)
+        if args.export:
+            samples["export"] = [measure_export(directory) for _ in range(args.runs)]
+
+    report = {key: round(statistics.median(values), 3) for key, values in samples.items()}
+    report["runs"] = args.runs
+    report["records"] = args.records
+    report["heavy_after_render"] = sorted(heavy)
+    print(f"{'Messwert':>12} {'Median (s)':>11}")
+    for key, values in samples.items():
+        print(f"{key:>12} {report[key]:>11.3f}")
+    print("Nach dem ersten Rendern geladen:", ", ".join(report["heavy_after_render"]) or "-")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, indent=4)
+    return 1 if heavy else 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        run_once(int(sys.argv[2]), sys.argv[3] == "1")
+    else:
+        sys.exit(main())
@@ -0,0 +1,64 @@
+# Peak RSS und Laufzeit von Invoice.create_file im Standard- und constant_memory-Modus
+#
+#   python benchmarks/bench_writer.py                 # 10k, 100k, 1M Datensätze
+#   python benchmarks/bench_writer.py 10000 50000     # eigene Größen
+#
+# Jede Messung läuft in einem eigenen Prozess, damit sich die Peak-RSS-Werte
+# nicht gegenseitig beeinflussen.
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate import write_epay21
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+MODES = ("standard", "constant_memory")
+
+
+def run_once(path, mode):
+    from Invoice import Invoice
+    with open(os.path.join(ROOT, "configs", "current_config.json"), "r", encoding="utf-8") as fd:
+        usk_liste = fd.read()
+    config = {"files": {"source_path": os.path.dirname(path) + os.sep},
+              "usk": {"usk_liste": usk_liste}}
+    start = time.perf_counter()
+    invoice = Invoice(os.path.basename(path), config)
+    invoice.create_file(BytesIO(), constant_memory=(mode == "constant_memory"))
+    print(time.perf_counter() - start)
+
+
+def measure(path, mode):
+    proc = subprocess.Popen([sys.executable, __file__, "--run", path, mode], stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    if status != 0:
+        raise RuntimeError(f"Messung {mode} für {path} fehlgeschlagen")
+    # ru_maxrss ist unter Linux in KiB
+    return float(output), usage.ru_maxrss / 1024
+
+
+def main(sizes):
+    print(f"{'Datensätze':>12} {'Modus':>16} {'Zeit (s)':>10} {'Zeilen/s':>10} {'Peak RSS (MiB)':>15}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for records in sizes:
+            path = os.path.join(temp_dir, f"bench_{records}.xml")
+            with open(path, "w", encoding="utf-8") as fd:
+                write_epay21(fd, records)
+            for mode in MODES:
+                seconds, rss = measure(path, mode)
+                print(f"{records:>12} {mode:>16} {seconds:>10.2f} {records / seconds:>10.0f} {rss:>15.1f}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        run_once(sys.argv[2], sys.argv[3])
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,102 @@
+# Erzeugt synthetische epay21Finance-Dateien für Benchmarks und lokale Tests
+#
+#   python benchmarks/generate.py beispiel.xml --records 100000 --seed 1
+#
+# Die Verfahren und Schlüssel entsprechen configs/current_config.json, damit alle
+# Datensätze auflösbar sind. Purpose/PayerInfo fehlen zufällig, wo das erlaubt ist.
+import argparse
+import io
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+
+# Verfahren -> (Anteil, mögliche Verwendungszwecke)
+APPS = {
+    "xSta": (0.35, ("Geburtsurkunde", "Sterbeurkunde", "Eheurkunde")),
+    "iKFZ": (0.25, ("Zulassung", "Außerbetriebsetzung", "Umschreibung")),
+    "hsh.olav": (0.25, ("FueZ/{n}", "MeldeB/{n}", "GZRA/{n}", "AUFB/{n}")),
+    "civento": (0.15, ("11500.10002-{n}", "32100.10001-{n}")),
+}
+# Nur bei diesen Verfahren hängt die USK nicht am Verwendungszweck
+OPTIONAL_PURPOSE = ("xSta", "iKFZ")
+PAY_METHODS = ("giropay", "creditcard", "paypal", "paydirekt", "sepa")
+
+
+def iter_entries(records, seed=0, missing_ratio=0.1):
+    rng = random.Random(seed)
+    apps = list(APPS)
+    weights = [APPS[app][0] for app in apps]
+    start = datetime(2024, 1, 1)
+    for n in range(records):
+        app = rng.choices(apps, weights)[0]
+        entry = {
+            "epay21App": app,
+            "Amount": rng.randint(500, 15000),
+            "Currency": "EUR",
+            "PayerInfo": f"Einzahler {rng.randint(1, 99999)}",
+            "Purpose": rng.choice(APPS[app][1]).format(n=n),
+            "Timestamp": (start + timedelta(seconds=n * 17)).isoformat(),
+            "PayMethod": rng.choice(PAY_METHODS),
+        }
+        if rng.random() < missing_ratio:
+            del entry["PayerInfo"]
+        if app in OPTIONAL_PURPOSE and rng.random() < missing_ratio:
+            del entry["Purpose"]
+        yield entry
+
+
+def _cents(value):
+    return f"{value // 100}.{value % 100:02d}"
+
+
+def write_epay21(fd, records, seed=0, missing_ratio=0.1, file_name="synthetic.xml"):
+    # fd: Text-Datei. Die Summe für den Kopf kommt aus einem ersten Durchlauf mit
+    # demselben Seed, so bleibt auch bei Millionen Datensätzen nichts im Speicher
+    total = sum(entry["Amount"] for entry in iter_entries(records, seed, missing_ratio))
+    header = {
+        "FileSender": "epay21-synthetic",
+        "FileName": file_name,
+        "FileTimestamp": "2024-02-01T02:00:00",
+        "PeriodFrom": "2024-01-01",
+        "PeriodTo": "2024-01-31",
+        "Amount": _cents(total),
+        "Currency": "EUR",
+    }
+    fd.write('<?xml version="1.0" encoding="UTF-8"?>\n<epay21Finance>\n  <PSPData>\n')
+    for key, value in header.items():
+        fd.write(f"    <{key}>{escape(value)}</{key}>\n")
+    fd.write("  </PSPData>\n  <Records>\n")
+    for entry in iter_entries(records, seed, missing_ratio):
+        entry["Amount"] = _cents(entry["Amount"])
+        fd.write("    <RecordEntry>\n")
+        for key, value in entry.items():
+            fd.write(f"      <{key}>{escape(value)}</{key}>\n")
+        fd.write("    </RecordEntry>\n")
+    fd.write("  </Records>\n</epay21Finance>\n")
+
+
+def generate_bytes(records, seed=0, missing_ratio=0.1, file_name="synthetic.xml"):
+    fd = io.StringIO()
+    write_epay21(fd, records, seed, missing_ratio, file_name)
+    return fd.getvalue().encode("utf-8")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetische epay21-XML erzeugen")
+    parser.add_argument("output", help="Zieldatei, '-' für stdout")
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--missing-ratio", type=float, default=0.1,
+                        help="Anteil der Datensätze ohne PayerInfo bzw. Purpose")
+    args = parser.parse_args(argv)
+    if args.output == "-":
+        write_epay21(sys.stdout, args.records, args.seed, args.missing_ratio)
+    else:
+        with open(args.output, "w", encoding="utf-8") as fd:
+            write_epay21(fd, args.records, args.seed, args.missing_ratio, file_name=os.path.basename(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Lasttest für die HTTP-Schnittstelle (api.py) mit synthetischen Daten
+#
+#   uvicorn api:app --port 8000 &
+#   python benchmarks/load_api.py --url http://localhost:8000/convert
+#   python benchmarks/load_api.py --requests 200 --concurrency 16 --files 3 --records 5000
+#
+# Schickt --requests Anfragen mit je --files Dateien, davon --concurrency
+# gleichzeitig, und meldet Statuscodes, Durchsatz und Latenzen (p50/p95/max).
+# Jede Anfrage bekommt eigene Dateien (anderer Seed), sonst käme alles aus dem Cache.
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate import generate_bytes
+
+
+def multipart(files, fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for key, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode())
+    for name, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+                     f'Content-Type: application/xml\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def send(url, body, content_type, timeout):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except Exception as e:
+        status = type(e).__name__
+    return status, time.perf_counter() - start
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))] if values else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lasttest für POST /convert")
+    parser.add_argument("--url", default="http://localhost:8000/convert")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--files", type=int, default=2, help="Dateien pro Anfrage")
+    parser.add_argument("--records", type=int, default=2000, help="Datensätze pro Datei")
+    parser.add_argument("--formats", default="xlsx")
+    parser.add_argument("--consolidated", action="store_true")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", help="Ergebnis zusätzlich als JSON speichern")
+    args = parser.parse_args(argv)
+
+    fields = {"formats": args.formats}
+    if args.consolidated:
+        fields["consolidated"] = "1"
+    bodies = []
+    for number in range(args.requests):
+        files = [(f"last_{number}_{index}.xml", generate_bytes(args.records, seed=number * args.files + index,
+                                                                file_name=f"last_{number}_{index}.xml"))
+                 for index in range(args.files)]
+        bodies.append(multipart(files, fields))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda body: send(args.url, *body, args.timeout), bodies))
+    seconds = time.perf_counter() - start
+
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    latencies = [latency for status, latency in results if status == 200]
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "files_per_request": args.files,
+        "records_per_file": args.records,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(args.requests / seconds, 2),
+        "records_per_second": round(len(latencies) * args.files * args.records / seconds),
+        "status": statuses,
+        "latency_p50": round(percentile(latencies, 0.5), 3),
+        "latency_p95": round(percentile(latencies, 0.95), 3),
+        "latency_max": round(max(latencies, default=0.0), 3),
+    }
+    print(json.dumps(report, indent=4))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, indent=4)
+    return 0 if statuses.get("200") == args.requests else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from json import dumps
+
+# Obergrenze für zwischengespeicherte Ergebnisse, über INVOICE_PARSER_CACHE_MB einstellbar
+DEFAULT_CACHE_MB = 256
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def config_hash(usk_config):
+    # Normalisiert: gleiche Zuordnung in anderer Reihenfolge ergibt denselben Hash
+    return hashlib.sha256(dumps(usk_config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def result_size(result):
+    return sum(len(output["content"]) for output in result["outputs"])
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        # XML-Hash -> Cache-Schlüssel aller USK-Listen, mit denen die Datei vorliegt
+        self.by_content = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry)
+
+    def variants(self, xml_hash):
+        with self.lock:
+            return [(key, dict(self.entries[key])) for key in self.by_content.get(xml_hash, ())]
+
+    def put(self, key, result):
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= result_size(old)
+            self.entries[key] = dict(result)
+            if old is None:
+                self.by_content.setdefault(key[0], []).append(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= result_size(evicted)
+                self.by_content[evicted_key[0]].remove(evicted_key)
+                if not self.by_content[evicted_key[0]]:
+                    del self.by_content[evicted_key[0]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_content.clear()
+            self.size = 0
+
+
+# Prozessweiter Cache, überlebt die Reruns der marimo-Zellen
+result_cache = ResultCache(int(os.environ.get("INVOICE_PARSER_CACHE_MB", DEFAULT_CACHE_MB)) * 1024 * 1024)
@@ -0,0 +1,200 @@
+import glob
+import os
+import threading
+from datetime import datetime
+from json import dumps, load, loads
+
+from atomic import write_atomic
+from cache import config_hash, content_hash
+from usk import RULES_KEY
+
+# Gruppe der Tabelle für Einträge ohne eigene Gruppe (oberste Ebene der USK-Liste)
+BASIS = "BASIS"
+
+MANIFEST_NAME = "manifest.json"
+VERSION_PATTERN = "config_*.json"
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+# Pfad -> Hash des zuletzt geschriebenen bzw. gelesenen Inhalts
+_saved_hashes = {}
+_save_lock = threading.Lock()
+
+
+def table_to_config(frame, group_column, name_column, usk_column, rules=None):
+    # Tabelle des Editors (DataFrame oder Liste von Zeilen-dicts) -> USK-Liste.
+    # Wie bisher: Werte werden als Text getrimmt, Zeilen ohne Name oder USK
+    # übersprungen, leere Gruppe = BASIS, bei doppelten Einträgen gewinnt die
+    # letzte Zeile, die Reihenfolge folgt dem ersten Auftreten. Schlüsselregeln
+    # (RULES_KEY) stehen nicht in der Tabelle und werden über rules übernommen.
+    # pandas erst hier laden, die Oberfläche braucht es zum Anzeigen nicht
+    import pandas as pd
+
+    if not isinstance(frame, pd.DataFrame):
+        # Im Editor neu angelegte Zeilen haben None in noch leeren Zellen
+        frame = pd.DataFrame(list(frame), columns=[group_column, name_column, usk_column], dtype=object).fillna("")
+    table = pd.DataFrame({
+        "group": frame[group_column].map(str).str.strip(),
+        "name": frame[name_column].map(str).str.strip(),
+        "usk": frame[usk_column].map(str).str.strip(),
+    })
+    table = table[(table["name"] != "") & (table["usk"] != "")]
+    table.loc[table["group"] == "", "group"] = BASIS
+    entries = table.groupby(["group", "name"], sort=False)["usk"].last()
+
+    config = {}
+    for (group, name), usk in entries.items():
+        if group == BASIS:
+            config[name] = usk
+        else:
+            config.setdefault(group, {})[name] = usk
+    if rules:
+        config[RULES_KEY] = dict(rules)
+    return config
+
+
+def config_bytes(config):
+    # Gleiches Format wie json.dump(..., indent=4) in den bisherigen Dateien
+    return dumps(config, indent=4).encode("utf-8")
+
+
+def _file_hash(path):
+    try:
+        with open(path, "rb") as fd:
+            return content_hash(fd.read())
+    except OSError:
+        return None
+
+
+def save_config(path, config):
+    # Schreibt nur, wenn sich der Inhalt geändert hat; True, wenn geschrieben wurde
+    content = config_bytes(config)
+    new_hash = content_hash(content)
+    with _save_lock:
+        if _saved_hashes.get(path) == new_hash and os.path.exists(path):
+            return False
+        if _file_hash(path) == new_hash:
+            _saved_hashes[path] = new_hash
+            return False
+        write_atomic(path, content)
+        _saved_hashes[path] = new_hash
+        return True
+
+
+def flatten_config(config):
+    # USK-Liste -> {(Gruppe, Name): USK}, Einträge der obersten Ebene unter BASIS,
+    # Schlüsselregeln sind keine Zuordnungen
+    entries = {}
+    for key, value in config.items():
+        if key == RULES_KEY:
+            continue
+        if isinstance(value, dict):
+            for name, usk in value.items():
+                entries[(key, name)] = usk
+        else:
+            entries[(BASIS, key)] = value
+    return entries
+
+
+def diff_configs(current, other):
+    # Was sich ändert, wenn other die aktuelle USK-Liste ersetzt
+    old, new = flatten_config(current), flatten_config(other)
+    return {
+        "added": sorted((group, name, new[(group, name)]) for group, name in new.keys() - old.keys()),
+        "removed": sorted((group, name, old[(group, name)]) for group, name in old.keys() - new.keys()),
+        "changed": sorted((group, name, old[(group, name)], new[(group, name)])
+                          for group, name in old.keys() & new.keys() if old[(group, name)] != new[(group, name)]),
+    }
+
+
+class ConfigStore:
+    # Gesicherte Versionen der USK-Liste (config_<Zeitstempel>_<N>rows.json) mit
+    # einem Manifest (manifest.json): Zeitstempel, Anzahl Einträge und Hash pro
+    # Version. Die Liste kommt aus dem Manifest, ohne die Versionen selbst zu
+    # lesen; gleiche Inhalte werden nur einmal gespeichert.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self._versions = None
+        self._mtime = None
+
+    def _read_manifest(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            self._versions = self._migrate()
+            self._write_manifest()
+            return
+        if self._versions is None or mtime != self._mtime:
+            with open(self.manifest_path, "r", encoding="utf-8") as fd:
+                self._versions = load(fd)["versions"]
+            self._mtime = mtime
+
+    def _write_manifest(self):
+        content = dumps({"versions": self._versions}, ensure_ascii=False, indent=4).encode("utf-8")
+        write_atomic(self.manifest_path, content)
+        self._mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def _migrate(self):
+        # Einmalig: vorhandene Sicherungen ins Manifest übernehmen, Duplikate
+        # (gleicher Hash) nur mit der neuesten Datei
+        versions = {}
+        for path in glob.glob(os.path.join(self.directory, VERSION_PATTERN)):
+            try:
+                with open(path, "r", encoding="utf-8") as fd:
+                    config = load(fd)
+            except (OSError, ValueError):
+                continue
+            name = os.path.basename(path)
+            try:
+                timestamp = datetime.strptime("_".join(name[len("config_"):].split("_")[:2]), TIMESTAMP_FORMAT)
+            except ValueError:
+                timestamp = datetime.fromtimestamp(os.path.getmtime(path))
+            version = {
+                "file": name,
+                "timestamp": timestamp.isoformat(timespec="seconds"),
+                "rows": len(flatten_config(config)),
+                "hash": config_hash(config),
+            }
+            previous = versions.get(version["hash"])
+            if previous is None or previous["timestamp"] < version["timestamp"]:
+                versions[version["hash"]] = version
+        return sorted(versions.values(), key=lambda version: version["timestamp"])
+
+    def versions(self):
+        # Neueste zuerst
+        with self.lock:
+            self._read_manifest()
+            return list(reversed(self._versions))
+
+    def find(self, usk_config):
+        digest = config_hash(usk_config)
+        return next((version for version in self.versions() if version["hash"] == digest), None)
+
+    def snapshot(self, usk_config, now=None):
+        # Legt eine neue Version an; (Version, True) oder bei gleichem Inhalt die
+        # vorhandene Version und False
+        digest = config_hash(usk_config)
+        with self.lock:
+            self._read_manifest()
+            for version in self._versions:
+                if version["hash"] == digest:
+                    return version, False
+            timestamp = now or datetime.now()
+            rows = len(flatten_config(usk_config))
+            name = f"config_{timestamp.strftime(TIMESTAMP_FORMAT)}_{rows}rows.json"
+            suffix = 1
+            while os.path.exists(os.path.join(self.directory, name)):
+                suffix += 1
+                name = f"config_{timestamp.strftime(TIMESTAMP_FORMAT)}_{rows}rows_{suffix}.json"
+            write_atomic(os.path.join(self.directory, name), config_bytes(usk_config))
+            version = {"file": name, "timestamp": timestamp.isoformat(timespec="seconds"), "rows": rows,
+                       "hash": digest}
+            self._versions.append(version)
+            self._write_manifest()
+            return version, True
+
+    def load(self, file):
+        with open(os.path.join(self.directory, os.path.basename(file)), "rb") as fd:
+            return loads(fd.read())
@@ -0,0 +1,563 @@
+import os
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from Invoice import Invoice, iter_records, output_name, split_records
+from atomic import write_atomic
+from cache import config_hash, content_hash, result_size
+from metrics import Metrics
+from preflight import merge, scan_file
+from reconcile import AmountTotals
+from usk import USKResolver, changed_keys
+
+# Obergrenze, falls INVOICE_PARSER_WORKERS nicht gesetzt ist
+DEFAULT_WORKERS = 4
+DEFAULT_FORMATS = ("xlsx",)
+# Grobe Schätzung pro Worker (Interpreter, Parser, Workbook im Speicher)
+WORKER_MEMORY_MB = 256
+# Ab dieser Größe wird eine einzelne Datei in Stücke geteilt und im Pool geparst
+# (INVOICE_PARSER_SHARD_MB); Größe der Stücke in MB
+DEFAULT_SHARD_MB = 32
+SHARD_CHUNK_MB = 4
+
+_executor = None
+_executor_workers = 0
+_sync_manager = None
+
+# Pro Worker-Prozess: zuletzt kompilierte USK-Liste
+_worker_resolver = None
+_worker_resolver_key = None
+
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # CPU-Limit des Containers (cgroup v2)
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as fd:
+            quota, period = fd.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def available_memory_mb():
+    # Speicherlimit des Containers (cgroup v2, dann v1), None wenn unbegrenzt
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path, "r") as fd:
+                value = fd.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value) // (1024 * 1024)
+    return None
+
+
+def worker_count(requested=None):
+    if requested is None:
+        requested = int(os.environ.get("INVOICE_PARSER_WORKERS", DEFAULT_WORKERS))
+    limit = available_cpus()
+    memory = available_memory_mb()
+    if memory is not None:
+        limit = min(limit, max(1, memory // WORKER_MEMORY_MB))
+    return max(1, min(requested, limit))
+
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def get_executor(workers):
+    # Der Pool bleibt über mehrere Stapel hinweg bestehen, damit nicht bei jedem
+    # Upload neue Prozesse gestartet werden müssen
+    global _executor, _executor_workers
+    if _executor is not None and _executor_workers != workers:
+        shutdown()
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=_context())
+        _executor_workers = workers
+    return _executor
+
+
+def shutdown():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+    _executor_workers = 0
+
+
+def _worker_ready():
+    # Der Import von conversion im Worker lädt bereits Invoice, pandas und xlsxwriter
+    return os.getpid()
+
+
+def warm_pool(workers=None):
+    # Startet die Worker-Prozesse und den Manager für Fortschritt/Abbruch vorab,
+    # damit der erste Upload nicht auf sie warten muss
+    workers = worker_count(workers)
+    if workers <= 1:
+        return
+    executor = get_executor(workers)
+    _manager()
+    for future in [executor.submit(_worker_ready) for _ in range(workers)]:
+        future.result()
+
+
+def _resolver_for(usk_config, key):
+    global _worker_resolver, _worker_resolver_key
+    if _worker_resolver_key != key:
+        _worker_resolver = USKResolver(usk_config)
+        _worker_resolver_key = key
+    return _worker_resolver
+
+
+class Cancelled(Exception):
+    pass
+
+
+class ProgressReporter:
+    # Wird an Invoice.export übergeben: meldet die Anzahl geschriebener Datensätze
+    # in counts[key] und bricht ab, sobald cancel gesetzt ist. counts/cancel sind
+    # für Worker-Prozesse Manager-Proxies (siehe shared_progress/shared_event).
+
+    def __init__(self, counts, key, cancel=None):
+        self.counts = counts
+        self.key = key
+        self.cancel = cancel
+
+    def __call__(self, count):
+        if self.counts is not None:
+            self.counts[self.key] = count
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled("Konvertierung abgebrochen")
+
+
+def _manager():
+    global _sync_manager
+    if _sync_manager is None:
+        _sync_manager = _context().Manager()
+    return _sync_manager
+
+
+def shared_progress(workers=None):
+    # Fortschrittszähler, die auch aus Worker-Prozessen beschrieben werden können
+    return _manager().dict() if worker_count(workers) > 1 else {}
+
+
+def shared_event(workers=None):
+    return _manager().Event() if worker_count(workers) > 1 else threading.Event()
+
+
+def convert(name, contents, resolver, formats=DEFAULT_FORMATS, metrics=None, progress=None):
+    # "used" merkt sich, welche USK-Einträge die Datei tatsächlich gebraucht hat
+    invoice = Invoice(name, {}, resolver=resolver, source=contents, metrics=metrics)
+    outputs = invoice.export(formats, progress=progress)
+    return {"outputs": outputs, "used": invoice.used, "reconciliation": invoice.reconciliation}
+
+
+def convert_file(name, contents, usk_config, key=None, formats=DEFAULT_FORMATS, progress=None):
+    # Läuft im Worker; Fehler werden als Ergebnis zurückgegeben, damit eine
+    # kaputte Datei den restlichen Stapel nicht abbricht
+    metrics = Metrics()
+    try:
+        result = convert(name, contents, _resolver_for(usk_config, key or config_hash(usk_config)), formats,
+                         metrics, progress)
+        result["error"] = None
+    except Exception as e:
+        result = {"outputs": [], "error": str(e)}
+    result["source"] = name
+    result["metrics"] = metrics.as_dict()
+    return result
+
+
+def shard_bytes():
+    return int(os.environ.get("INVOICE_PARSER_SHARD_MB", DEFAULT_SHARD_MB)) * 1024 * 1024
+
+
+def parse_chunk(chunk, usk_config, key=None):
+    # Läuft im Worker: ein Stück aus split_records -> Zeilenwerte in Dateireihenfolge
+    metrics = Metrics()
+    resolver = _resolver_for(usk_config, key or config_hash(usk_config))
+    used = set()
+    try:
+        with metrics.stage("parse"):
+            records = list(iter_records(chunk))
+        with metrics.stage("usk"):
+            rows = [record.values(resolver.resolve(record.epay21App, record.Purpose, used)) for record in records]
+        error = None
+    except Exception as e:
+        rows = []
+        error = str(e)
+    return {"rows": rows, "used": used, "error": error, "metrics": metrics.as_dict()}
+
+
+def convert_sharded(name, contents, usk_config, key=None, formats=DEFAULT_FORMATS, workers=None, progress=None):
+    # Eine große Datei: Parsen und USK-Auflösung stückweise im Pool, geschrieben
+    # wird hier mit einem einzigen Invoice.export in Dateireihenfolge. Ausgaben,
+    # Blatt "Informationen" und Abgleich sind dieselben wie bei convert_file.
+    key = key or config_hash(usk_config)
+    metrics = Metrics()
+    used = set()
+    waited = 0.0
+
+    def rows(ordered):
+        nonlocal waited
+        for future in ordered:
+            start = time.perf_counter()
+            chunk = future.result()
+            waited += time.perf_counter() - start
+            if chunk["error"]:
+                raise Exception(chunk["error"])
+            used.update(chunk["used"])
+            for stage, seconds in chunk["metrics"]["seconds"].items():
+                metrics.add_time(stage, seconds)
+            yield from chunk["rows"]
+
+    jobs = ((chunk, usk_config, key) for chunk in split_records(bytes(contents), int(SHARD_CHUNK_MB * 1024 * 1024)))
+    ordered = iter_ordered(get_executor(worker_count(workers)), parse_chunk, jobs, 2 * worker_count(workers))
+    start = time.perf_counter()
+    try:
+        with metrics.stage("header"):
+            invoice = Invoice(name, {}, resolver=_resolver_for(usk_config, key), source=contents)
+        # Eigene Messung für export: Zählen der Datensätze (parse) und Abgleich
+        # gehören nicht zur Schreibzeit, die hier als Rest übrig bleibt
+        invoice.metrics = own = Metrics()
+        outputs = invoice.export(formats, progress=progress, rows=rows(ordered))
+        scanned, reconciled = own.seconds.get("parse", 0.0), own.seconds.get("reconcile", 0.0)
+        metrics.add_time("parse", scanned)
+        metrics.add_time("reconcile", reconciled)
+        metrics.add_time("write", time.perf_counter() - start - metrics.seconds["header"] - waited - scanned
+                         - reconciled)
+        result = {"outputs": outputs, "used": used, "reconciliation": invoice.reconciliation, "error": None}
+        metrics.count("records", invoice.reconciliation["records"])
+        metrics.count("bytes_out", sum(len(output["content"]) for output in outputs))
+    except Exception as e:
+        result = {"outputs": [], "error": str(e)}
+    finally:
+        ordered.close()
+    metrics.count("bytes_in", len(contents))
+    result["source"] = name
+    result["metrics"] = metrics.as_dict()
+    return result
+
+
+def preflight_file(name, contents, usk_config, key=None):
+    # Läuft im Worker, nutzt dieselbe kompilierte USK-Liste wie convert_file
+    return scan_file(name, contents, _resolver_for(usk_config, key or config_hash(usk_config)))
+
+
+def scan_batch(files, usk_config, workers=None):
+    # Vorabprüfung aller Dateien (siehe preflight), bei Bedarf im Worker-Pool
+    key = config_hash(usk_config)
+    workers = worker_count(workers)
+    if workers <= 1 or len(files) <= 1:
+        return merge([preflight_file(name, contents, usk_config, key) for name, contents in files])
+    executor = get_executor(workers)
+    futures = [executor.submit(preflight_file, name, contents, usk_config, key) for name, contents in files]
+    scans = []
+    broken = False
+    for (name, _), future in zip(files, futures):
+        try:
+            scans.append(future.result())
+        except Exception as e:
+            broken = broken or isinstance(e, BrokenProcessPool)
+            scans.append({"source": name, "records": 0, "missing": {}, "error": str(e)})
+    if broken:
+        shutdown()
+    return merge(scans)
+
+
+def convert_path(file, source_path, destination_path, usk_config, key=None, formats=DEFAULT_FORMATS,
+                 archive=True):
+    # Stapelbetrieb: liest source_path + file, schreibt die Ausgaben nach
+    # destination_path und verschiebt die XML danach über cleanup() ins Archiv
+    metrics = Metrics()
+    try:
+        config = {"files": {"source_path": source_path, "destination_path": destination_path}}
+        invoice = Invoice(file, config, resolver=_resolver_for(usk_config, key or config_hash(usk_config)),
+                          metrics=metrics)
+        written = []
+        for output in invoice.export(formats):
+            path = destination_path + output["name"]
+            write_atomic(path, output["content"])
+            written.append(path)
+        if archive:
+            invoice.OutputFile = written[0]
+            invoice.cleanup()
+        return {"source": file, "outputs": written, "error": None, "metrics": metrics.as_dict(),
+                "reconciliation": invoice.reconciliation}
+    except Exception as e:
+        return {"source": file, "outputs": [], "error": str(e), "metrics": metrics.as_dict()}
+
+
+def _find_reusable(cache, key, usk_config, diffs):
+    # Ergebnis derselben Datei mit einer anderen USK-Liste, wenn keiner der von ihr
+    # verwendeten Einträge geändert wurde
+    for variant_key, entry in cache.variants(key[0]):
+        if variant_key[1] == key[1] or variant_key[2] != key[2]:
+            continue
+        changed = diffs.get(variant_key[1])
+        if changed is None:
+            changed = diffs[variant_key[1]] = changed_keys(entry["usk_config"], usk_config)
+        if not changed & entry["used"]:
+            return entry
+    return None
+
+
+def _failed(name, error):
+    return {"source": name, "outputs": [], "error": error, "cached": False, "reused": False}
+
+
+def iter_batch(files, usk_config, workers=None, cache=None, formats=DEFAULT_FORMATS, progress=None, cancel=None):
+    # files: Liste von (Dateiname, Inhalt). Liefert (Index, Ergebnis) in der
+    # Reihenfolge, in der die Dateien fertig werden - Cache-Treffer zuerst.
+    # Mit cache werden Dateien, die mit derselben USK-Liste schon konvertiert
+    # wurden, nicht erneut verarbeitet (result["cached"] ist dann True). Nach
+    # einer Änderung der USK-Liste werden nur Dateien neu konvertiert, die einen
+    # geänderten Eintrag verwendet haben (result["reused"] ist sonst True).
+    # result["outputs"] enthält pro gewähltem Format {"name", "suffix", "content"}.
+    # progress (shared_progress) bekommt pro Index die Anzahl geschriebener
+    # Datensätze, cancel (shared_event) bricht laufende und wartende Dateien ab.
+    # Bleibt nur eine Datei übrig und ist sie groß genug (shard_bytes), wird sie
+    # mit convert_sharded auf die Worker verteilt.
+    formats = tuple(formats)
+    key = config_hash(usk_config)
+    pending = []
+    diffs = {}
+    for index, (name, contents) in enumerate(files):
+        cache_key = None
+        if cache is not None:
+            start = time.perf_counter()
+            cache_key = (content_hash(contents), key, formats)
+            cached = cache.get(cache_key)
+            reused = False
+            if cached is None:
+                cached = _find_reusable(cache, cache_key, usk_config, diffs)
+                if cached is not None:
+                    cached["usk_config"] = usk_config
+                    cache.put(cache_key, cached)
+                    reused = True
+            if cached is not None:
+                cached["outputs"] = [dict(output, name=output_name(name, output["suffix"]))
+                                     for output in cached["outputs"]]
+                cached.update(source=name, error=None, cached=True, reused=reused, metrics={
+                    "seconds": {"cache": time.perf_counter() - start},
+                    "counts": {"bytes_in": len(contents), "bytes_out": result_size(cached)},
+                })
+                yield index, cached
+                continue
+            lookup = time.perf_counter() - start
+        else:
+            lookup = None
+        pending.append((index, cache_key, lookup, name, contents))
+
+    def finish(cache_key, lookup, result):
+        if lookup is not None and "metrics" in result:
+            result["metrics"]["seconds"]["cache"] = lookup
+        result["cached"] = False
+        result["reused"] = False
+        if cache is not None and not result["error"] and result["outputs"]:
+            cache.put(cache_key, {"outputs": result["outputs"], "used": result["used"], "usk_config": usk_config,
+                                  "reconciliation": result["reconciliation"]})
+        return result
+
+    workers = worker_count(workers)
+    if workers <= 1 or len(pending) <= 1:
+        for index, cache_key, lookup, name, contents in pending:
+            if cancel is not None and cancel.is_set():
+                yield index, _failed(name, "Konvertierung abgebrochen")
+                continue
+            reporter = ProgressReporter(progress, index, cancel)
+            if workers > 1 and len(contents) >= shard_bytes():
+                # Einzelne große Datei: die Worker teilen sich die Datensätze
+                result = convert_sharded(name, contents, usk_config, key, formats, workers, reporter)
+            else:
+                result = convert_file(name, contents, usk_config, key, formats, reporter)
+            yield index, finish(cache_key, lookup, result)
+        return
+
+    executor = get_executor(workers)
+    futures = {}
+    for index, cache_key, lookup, name, contents in pending:
+        reporter = ProgressReporter(progress, index, cancel)
+        future = executor.submit(convert_file, name, contents, usk_config, key, formats, reporter)
+        futures[future] = (index, cache_key, lookup, name)
+    broken = False
+    try:
+        for future in as_completed(futures):
+            index, cache_key, lookup, name = futures[future]
+            if cancel is not None and cancel.is_set():
+                for other in futures:
+                    other.cancel()
+            try:
+                result = finish(cache_key, lookup, future.result())
+            except Exception as e:
+                # Worker abgestürzt oder abgebrochen - nur diese Datei gilt als fehlerhaft
+                broken = broken or isinstance(e, BrokenProcessPool)
+                result = _failed(name, str(e) or "Konvertierung abgebrochen")
+            yield index, result
+    finally:
+        if broken:
+            shutdown()
+
+
+def iter_ordered(executor, function, jobs, window):
+    # Reicht höchstens window Aufgaben gleichzeitig ein und liefert die Futures in
+    # Eingabereihenfolge. Zwischen Worker und dem einen Writer liegen so nie mehr
+    # als window fertig geparste Dateien im Speicher.
+    pending = deque()
+    jobs = iter(jobs)
+    try:
+        while True:
+            while len(pending) < window:
+                args = next(jobs, None)
+                if args is None:
+                    break
+                pending.append(executor.submit(function, *args))
+            if not pending:
+                return
+            yield pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _tagged_chunks(files, usk_config, key, tags):
+    # parse_chunk-Aufgaben aller Dateien nacheinander; tags bekommt pro Aufgabe
+    # (Index, letztes Stück der Datei?) in derselben Reihenfolge
+    for index, (_, contents) in enumerate(files):
+        chunks = split_records(bytes(contents), int(SHARD_CHUNK_MB * 1024 * 1024))
+        current = next(chunks)
+        for following in chunks:
+            tags.append((index, False))
+            yield current, usk_config, key
+            current = following
+        tags.append((index, True))
+        yield current, usk_config, key
+
+
+def _chunk_results(files, usk_config, key, workers):
+    # -> (Index, letztes Stück?, parse_chunk-Ergebnis) in Upload- und Dateireihenfolge.
+    # Im Pool sind höchstens 2 * workers Stücke unterwegs bzw. fertig im Speicher.
+    tags = deque()
+    jobs = _tagged_chunks(files, usk_config, key, tags)
+    if workers <= 1:
+        for args in jobs:
+            result = parse_chunk(*args)
+            yield tags.popleft() + (result,)
+        return
+    ordered = iter_ordered(get_executor(workers), parse_chunk, jobs, 2 * workers)
+    broken = False
+    try:
+        for future in ordered:
+            try:
+                result = future.result()
+            except Exception as e:
+                broken = broken or isinstance(e, BrokenProcessPool)
+                result = {"rows": [], "used": set(), "error": str(e) or "Konvertierung abgebrochen", "metrics": None}
+            yield tags.popleft() + (result,)
+    finally:
+        ordered.close()
+        if broken:
+            shutdown()
+
+
+def iter_rows(files, usk_config, workers=None, progress=None, cancel=None):
+    # Für die zusammengefasste Arbeitsmappe: (Index, Ergebnis) streng in
+    # Upload-Reihenfolge. Geparst wird stückweise (SHARD_CHUNK_MB) im Pool wie bei
+    # convert_sharded, sodass auch große Dateien nie ganz als Zeilen im Speicher
+    # liegen. result["rows"] liefert die Zeilen und muss vor dem nächsten Ergebnis
+    # ganz gelesen werden; danach stehen "used", "reconciliation" und "metrics" im
+    # Ergebnis. Scheitert erst ein späteres Stück einer Datei, sind ihre ersten
+    # Zeilen schon geschrieben: rows wirft dann eine Exception.
+    key = config_hash(usk_config)
+    chunks = _chunk_results(files, usk_config, key, worker_count(workers))
+    done = 0
+    try:
+        for index, (name, contents) in enumerate(files):
+            if cancel is not None and cancel.is_set():
+                break
+            _, last, chunk = next(chunks)
+            if chunk["error"]:
+                # Restliche Stücke dieser Datei verwerfen
+                while not last:
+                    _, last, _ = next(chunks)
+                yield index, dict(_failed(name, chunk["error"]), rows=[])
+                done += 1
+                continue
+            metrics = Metrics()
+            result = {"source": name, "error": None, "used": set()}
+            try:
+                invoice = Invoice(name, {}, resolver=_resolver_for(usk_config, key), source=contents, metrics=metrics)
+            except Exception as e:
+                while not last:
+                    _, last, _ = next(chunks)
+                yield index, dict(_failed(name, str(e)), rows=[])
+                done += 1
+                continue
+            result["header"] = invoice.header()
+            result["rows"] = _file_rows(invoice, result, metrics, chunks, chunk, last,
+                                        ProgressReporter(progress, index), cancel)
+            metrics.count("bytes_in", len(contents))
+            yield index, result
+            done += 1
+    finally:
+        chunks.close()
+    for index in range(done, len(files)):
+        yield index, dict(_failed(files[index][0], "Konvertierung abgebrochen"), rows=[])
+
+
+def _file_rows(invoice, result, metrics, chunks, chunk, last, progress, cancel):
+    # Zeilen einer Datei aus ihren Stücken; Abgleich und Zähler wie in Invoice.write.
+    # "write" ist die Zeit beim Aufrufer (Arbeitsmappe) ohne das Warten auf Stücke.
+    totals = AmountTotals()
+    count = 0
+    waited = 0.0
+    start = time.perf_counter()
+    while True:
+        result["used"].update(chunk["used"])
+        for stage, seconds in chunk["metrics"]["seconds"].items():
+            metrics.add_time(stage, seconds)
+        rows, chunk = chunk["rows"], None
+        for values in rows:
+            totals.write_row(values)
+            yield values
+        count += len(rows)
+        progress(count)
+        del rows
+        if last:
+            break
+        if cancel is not None and cancel.is_set():
+            result["error"] = "Konvertierung abgebrochen"
+            result["metrics"] = metrics.as_dict()
+            return
+        wait_start = time.perf_counter()
+        _, last, chunk = next(chunks)
+        waited += time.perf_counter() - wait_start
+        if chunk["error"]:
+            raise Exception(f"{result['source']}: {chunk['error']} (nach {count} Datensätzen, "
+                            f"die Gesamtdatei wäre unvollständig)")
+    metrics.add_time("write", time.perf_counter() - start - waited)
+    with metrics.stage("reconcile"):
+        result["reconciliation"] = totals.summary(invoice.Amount)
+    metrics.count("records", count)
+    result["metrics"] = metrics.as_dict()
+
+
+def convert_batch(files, usk_config, workers=None, cache=None, formats=DEFAULT_FORMATS):
+    # Wie iter_batch, aber blockierend und mit Ergebnissen in Upload-Reihenfolge
+    results = [None] * len(files)
+    for index, result in iter_batch(files, usk_config, workers, cache, formats):
+        results[index] = result
+    return results
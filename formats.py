@@ -0,0 +1,198 @@
+import csv
+import io
+from json import dumps
+
+# Alle Ausgaben bekommen dieselben Kopfdaten (Blatt "Informationen") und dieselben
+# Spalten; write_row() wird einmal pro Datensatz aufgerufen, close() liefert die Bytes.
+# xlsxwriter, pandas und pyarrow werden erst im jeweiligen Writer geladen, damit
+# die Oberfläche FORMAT_LABELS ohne sie importieren kann.
+
+DATA_COLUMN_WIDTHS = (15, 15, 15, 15, 40, 40, 40, 15)
+SIDECAR_SUFFIX = ".info.json"
+PARQUET_ROW_GROUP = 50000
+# Zeilen pro Tabellenblatt in Excel (inklusive Kopfzeile)
+EXCEL_MAX_ROWS = 1048576
+CONSOLIDATED_NAME = "rechnungen_gesamt.xlsx"
+
+
+class XlsxOutput:
+    suffix = ".xlsx"
+
+    def __init__(self, header, columns, output=None, constant_memory=False):
+        # output: Zielpfad oder file-artiges Objekt, ohne Angabe ein BytesIO.
+        # constant_memory schreibt jede Zeile sofort in eine Temp-Datei und gibt sie
+        # frei; in_memory würde das abschalten und bleibt deshalb kleinen Dateien vorbehalten
+        import xlsxwriter
+
+        self.buffer = io.BytesIO() if output is None else output
+        if constant_memory:
+            options = {"constant_memory": True}
+        elif hasattr(self.buffer, "write"):
+            options = {"in_memory": True}
+        else:
+            options = {}
+        self.workbook = xlsxwriter.Workbook(self.buffer, options)
+
+        sheet1 = self.workbook.add_worksheet("Informationen")
+        self.sheet = self.workbook.add_worksheet("Daten")
+        sheet1.set_column(0, 0, 15)
+        sheet1.set_column(1, 1, 70)
+        for col, width in enumerate(DATA_COLUMN_WIDTHS):
+            self.sheet.set_column(col, col, width)
+
+        row = 0
+        for key, value in header:
+            sheet1.write_row(row, 0, (key, value))
+            row += 1
+
+        self.sheet.write_row(0, 0, columns)
+        self.row = 1
+
+    def write_row(self, values):
+        self.sheet.write_row(self.row, 0, values)
+        self.row += 1
+
+    def close(self):
+        self.workbook.close()
+        if isinstance(self.buffer, io.BytesIO):
+            return self.buffer.getvalue()
+        return None
+
+
+class ConsolidatedXlsxOutput:
+    # Eine Arbeitsmappe für den ganzen Stapel: "Informationen" mit einer Zeile
+    # Kopfdaten pro Datei, "Daten" mit allen Datensätzen und der Quelldatei in der
+    # ersten Spalte. Immer constant_memory, Dateien müssen in Reihenfolge kommen.
+    # Passt "Daten" nicht in ein Blatt, geht es in "Daten 2", "Daten 3" ... weiter.
+    suffix = ".xlsx"
+
+    def __init__(self, header_keys, columns, output=None):
+        import xlsxwriter
+
+        self.buffer = io.BytesIO() if output is None else output
+        self.workbook = xlsxwriter.Workbook(self.buffer, {"constant_memory": True})
+        self.columns = ["Datei"] + list(columns)
+        self.info = self.workbook.add_worksheet("Informationen")
+        self.info.set_column(0, 0, 40)
+        self.info.set_column(1, len(header_keys), 20)
+        self.info.write_row(0, 0, ["Datei"] + list(header_keys) + ["Datensätze"])
+        self.info_row = 1
+        self.sheets = 0
+        self._add_data_sheet()
+
+    def _add_data_sheet(self):
+        self.sheets += 1
+        self.sheet = self.workbook.add_worksheet("Daten" if self.sheets == 1 else f"Daten {self.sheets}")
+        self.sheet.set_column(0, 0, 40)
+        for col, width in enumerate(DATA_COLUMN_WIDTHS, start=1):
+            self.sheet.set_column(col, col, width)
+        self.sheet.write_row(0, 0, self.columns)
+        self.row = 1
+
+    def add_file(self, source, header, rows):
+        # header wie Invoice.header(), rows: Zeilenwerte in Spaltenreihenfolge
+        count = 0
+        for values in rows:
+            if self.row >= EXCEL_MAX_ROWS:
+                self._add_data_sheet()
+            self.sheet.write_string(self.row, 0, source)
+            self.sheet.write_row(self.row, 1, values)
+            self.row += 1
+            count += 1
+        self.info.write_row(self.info_row, 0, [source] + [value for _, value in header] + [count])
+        self.info_row += 1
+        return count
+
+    def close(self):
+        self.workbook.close()
+        if isinstance(self.buffer, io.BytesIO):
+            return self.buffer.getvalue()
+        return None
+
+
+class CsvOutput:
+    suffix = ".csv"
+
+    def __init__(self, header, columns):
+        # Semikolon und BOM, damit Excel die Datei ohne Importdialog korrekt öffnet
+        self.buffer = io.BytesIO()
+        self.text = io.TextIOWrapper(self.buffer, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.text, delimiter=";")
+        self.writer.writerow(columns)
+
+    def write_row(self, values):
+        self.writer.writerow(values)
+
+    def close(self):
+        self.text.flush()
+        return self.buffer.getvalue()
+
+
+class JsonLinesOutput:
+    suffix = ".jsonl"
+
+    def __init__(self, header, columns):
+        self.columns = columns
+        self.buffer = io.BytesIO()
+
+    def write_row(self, values):
+        self.buffer.write(dumps(dict(zip(self.columns, values)), ensure_ascii=False).encode("utf-8"))
+        self.buffer.write(b"\n")
+
+    def close(self):
+        return self.buffer.getvalue()
+
+
+class ParquetOutput:
+    suffix = ".parquet"
+
+    def __init__(self, header, columns):
+        try:
+            import pandas as pd
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("Für Parquet werden pandas und pyarrow benötigt.")
+        self.pd = pd
+        self.pa = pa
+        self.columns = columns
+        self.schema = pa.schema([(name, pa.string()) for name in columns])
+        self.buffer = io.BytesIO()
+        self.writer = pq.ParquetWriter(self.buffer, self.schema)
+        self.pending = []
+
+    def flush(self):
+        if self.pending:
+            frame = self.pd.DataFrame(self.pending, columns=self.columns, dtype=object)
+            self.writer.write_table(self.pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False))
+            self.pending = []
+
+    def write_row(self, values):
+        self.pending.append(values)
+        if len(self.pending) >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        return self.buffer.getvalue()
+
+
+FORMATS = {
+    "xlsx": XlsxOutput,
+    "csv": CsvOutput,
+    "jsonl": JsonLinesOutput,
+    "parquet": ParquetOutput,
+}
+
+FORMAT_LABELS = {
+    "Excel (.xlsx)": "xlsx",
+    "CSV (.csv)": "csv",
+    "JSON Lines (.jsonl)": "jsonl",
+    "Parquet (.parquet)": "parquet",
+}
+
+
+def sidecar(header):
+    # Kopfdaten für alle Formate ohne eigenes "Informationen"-Blatt
+    return dumps(dict(header), ensure_ascii=False, indent=4).encode("utf-8")
@@ -0,0 +1,399 @@
+import os
+import threading
+import time
+import traceback
+
+from Invoice import COLUMNS, HEADER_FIELDS, count_records
+from archive import ArchiveBuilder
+from cache import config_hash
+from conversion import DEFAULT_FORMATS, iter_batch, iter_rows, scan_batch, shared_event, shared_progress
+from formats import CONSOLIDATED_NAME, ConsolidatedXlsxOutput
+from ledger import check_files, get_ledger
+from metrics import Metrics, registry
+from preflight import missing_message
+from reconcile import SUMMARY_NAME, add_summary_sheets, is_balanced, mismatch_message, summary_workbook
+from scheduler import estimate_mb, scheduler
+
+# Ein Upload-Stapel läuft in einem Hintergrund-Thread, damit die Oberfläche
+# während der Konvertierung bedienbar bleibt. Die App fragt den Stand über
+# snapshot() ab; ein neuer Upload derselben Sitzung bricht den alten Stapel ab.
+
+WAITING = "wartet"
+CHECKING = "prüft"
+RUNNING = "läuft"
+DONE = "fertig"
+# Vorabprüfung hat fehlende USK-Zuordnungen gefunden, nichts wurde konvertiert
+BLOCKED = "gestoppt"
+CANCELLED = "abgebrochen"
+FAILED = "fehler"
+
+ZIP_NAME = "rechnungen_export.zip"
+# Abgeschlossene Jobs einer Sitzung werden nach so vielen Sekunden ohne neuen
+# Upload freigegeben (INVOICE_PARSER_JOB_TTL); marimo meldet das Ende einer Sitzung nicht
+DEFAULT_JOB_TTL = 3600
+
+
+def result_message(result):
+    filename = result["source"]
+    if result["error"]:
+        return f"❌ Fehler bei {filename}: {result['error']}"
+    if not result["outputs"]:
+        return f"⚠️ {filename}: Ausgabe wurde nicht erstellt."
+    if result.get("cached"):
+        return f"✅ {filename} erfolgreich verarbeitet (aus dem Cache)."
+    return f"✅ {filename} erfolgreich verarbeitet."
+
+
+class ConversionJob:
+
+    def __init__(self, files, usk_config, formats=DEFAULT_FORMATS, cache=None, workers=None, consolidated=False,
+                 session_key=None, lineage=None, partial=True):
+        # files: Liste von (Dateiname, Inhalt) wie bei convert_batch. consolidated:
+        # eine Arbeitsmappe für alle Dateien statt einer Ausgabe pro Datei im ZIP
+        # (formats und cache werden dann nicht verwendet). session_key: für die
+        # faire Reihenfolge im scheduler. lineage: Sitzung im Dateiverzeichnis, deren
+        # eigene frühere Läufe nicht als doppelte Dateien gemeldet werden. partial:
+        # False, wenn der Aufrufer bei einer fehlerhaften Datei gar nichts ausliefert
+        # (HTTP-API); dann kommt auch nichts ins Dateiverzeichnis
+        self.files = files
+        self.file_count = len(files)
+        self.usk_config = usk_config
+        self.formats = tuple(formats)
+        self.cache = cache
+        self.workers = workers
+        self.consolidated = consolidated
+        self.session_key = session_key
+        self.lineage = lineage
+        self.memory_mb = None
+        self.status = WAITING
+        self.results = [None] * len(files)
+        self.finished = 0
+        self.file_records = None
+        self.preflight = None
+        self.ledger = None
+        self.ledger_checks = None
+        self.partial = partial
+        # Erfolgreiche Dateien (Index), eingetragen werden sie erst mit dem Download in finish()
+        self.pending_records = []
+        self.progress = shared_progress(workers)
+        self.cancel_event = shared_event(workers)
+        self.log = []
+        self.problem_files = []
+        self.archive = None
+        self.workbook = None
+        self.single_output = None
+        # abstimmung.xlsx neben einer einzelnen Ausgabe (eigener Download statt ZIP)
+        self.summary_output = None
+        self.output_count = 0
+        self.batch_metrics = Metrics()
+        self.error = None
+        self.seconds = None
+        self.finished_at = None
+        # Für die Oberfläche: einmal erzeugte Elemente (z.B. mo.download) pro Job
+        self.ui = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def done(self):
+        return self.status in (DONE, BLOCKED, CANCELLED, FAILED)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="invoice-conversion", daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+        scheduler.wake()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            # Erst zählen und schätzen, dann auf einen Platz im Speicherbudget warten
+            file_records = [count_records(contents) for _, contents in self.files]
+            self.memory_mb = estimate_mb(self.files, file_records)
+            if not scheduler.admit(self.session_key, self, self.memory_mb, self.cancel_event.is_set):
+                self.log.append("⏹️ Konvertierung abgebrochen (neuer Upload).")
+                self.status = CANCELLED
+                return
+            self.status = CHECKING
+            self.check_ledger()
+            if self.check():
+                return
+            self.status = RUNNING
+            self.file_records = file_records
+            if self.consolidated:
+                self.convert_consolidated()
+            else:
+                for index, result in iter_batch(self.files, self.usk_config, self.workers, self.cache, self.formats,
+                                                self.progress, self.cancel_event):
+                    self.add_result(index, result)
+                    if not result["error"]:
+                        self.collect(result)
+                        self.pending_records.append(index)
+            if self.cancel_event.is_set():
+                self.log.append("⏹️ Konvertierung abgebrochen (neuer Upload).")
+                self.status = CANCELLED
+                if self.archive is not None:
+                    self.archive.discard()
+                if self.workbook is not None:
+                    self.workbook.close()
+                    self.workbook = None
+                return
+            self.finish()
+            self.status = DONE
+        except Exception as e:
+            self.error = f"{e}\n\n{traceback.format_exc()}"
+            self.status = FAILED
+            if self.workbook is not None:
+                self.workbook.close()
+                self.workbook = None
+        finally:
+            scheduler.release(self)
+            self.seconds = time.perf_counter() - start
+            self.finished_at = time.monotonic()
+            # Die Uploads braucht nach dem Lauf niemand mehr
+            self.files = None
+
+    def release(self):
+        # Download freigeben (ZIP im Temp-Speicher, einzelne Ausgabe), wenn der Job
+        # ersetzt wurde oder abgelaufen ist
+        if self.archive is not None:
+            self.archive.discard()
+            self.archive = None
+        self.single_output = None
+        self.summary_output = None
+
+    def add_result(self, index, result):
+        with self.lock:
+            self.results[index] = result
+            self.finished += 1
+            self.log.append(result_message(result))
+            mismatch = None if result["error"] else mismatch_message(result["source"], result.get("reconciliation"))
+            if mismatch:
+                self.log.append(mismatch)
+            if result["error"] or not result["outputs"] or mismatch:
+                self.problem_files.append(result["source"])
+
+    def convert_consolidated(self):
+        # Geparst wird stückweise parallel im Pool, geschrieben nur hier und streng
+        # in Upload-Reihenfolge in eine constant_memory-Arbeitsmappe (Schreibzeit
+        # steht in den Metriken der Datei, siehe conversion.iter_rows)
+        self.workbook = ConsolidatedXlsxOutput(HEADER_FIELDS, COLUMNS)
+        for index, result in iter_rows(self.files, self.usk_config, self.workers, self.progress, self.cancel_event):
+            rows = result.pop("rows")
+            result["outputs"] = []
+            if not result["error"]:
+                count = self.workbook.add_file(result["source"], result.pop("header"), rows)
+                # Abbruch mitten in der Datei setzt error erst beim Lesen der Zeilen
+                if not result["error"]:
+                    result["outputs"] = [{"name": CONSOLIDATED_NAME, "suffix": ".xlsx", "records": count}]
+            del rows
+            self.add_result(index, result)
+            if not result["error"]:
+                self.pending_records.append(index)
+
+    def check_ledger(self):
+        # Doppelte Uploads und überschneidende Zeiträume, nur anhand der Kopfdaten.
+        # Bekannte Dateien werden trotzdem ausgegeben (bei gleicher USK-Liste aus dem Cache)
+        try:
+            self.ledger = get_ledger()
+            with self.batch_metrics.stage("preflight"):
+                self.ledger_checks = check_files(self.ledger, self.files, self.lineage)
+        except Exception as e:
+            self.ledger = None
+            self.log.append(f"⚠️ Dateiverzeichnis nicht verfügbar, keine Prüfung auf doppelte Dateien: {e}")
+            return
+        for check in self.ledger_checks:
+            self.log.extend(check["messages"])
+
+    def record(self):
+        # Nur was ausgeliefert wird, gilt als konvertiert: abgebrochene Jobs kommen
+        # nicht bis hier, ohne partial auch keine Stapel mit fehlerhaften Dateien
+        if self.ledger is None or self.ledger_checks is None or self.cancel_event.is_set():
+            return
+        if not self.partial and any(result["error"] for result in self.results):
+            return
+        key = config_hash(self.usk_config)
+        for index in self.pending_records:
+            check, result = self.ledger_checks[index], self.results[index]
+            if check["header"] is None:
+                continue
+            try:
+                self.ledger.record(check["hash"], check["header"], result["source"], key, self.lineage)
+            except Exception as e:
+                self.log.append(f"⚠️ {result['source']} konnte nicht ins Dateiverzeichnis eingetragen werden: {e}")
+
+    def check(self):
+        # Vorabprüfung; True, wenn der Stapel wegen fehlender USK-Zuordnungen stoppt
+        with self.batch_metrics.stage("preflight"):
+            self.preflight = scan_batch(self.files, self.usk_config, self.workers)
+        if self.cancel_event.is_set():
+            self.log.append("⏹️ Konvertierung abgebrochen (neuer Upload).")
+            self.status = CANCELLED
+            return True
+        missing = self.preflight["missing"]
+        if not missing:
+            return False
+        files = sorted({name for entry in missing for name in entry["files"]})
+        self.log.append(
+            f"🔎 Vorabprüfung: {len(missing)} fehlende USK-Zuordnungen in {sum(entry['count'] for entry in missing)} "
+            f"Datensätzen aus {len(files)} Dateien. Es wurde nichts konvertiert - bitte die Zeilen unten in der "
+            f"Tabelle ergänzen.")
+        self.log.extend(missing_message(entry) for entry in missing)
+        self.problem_files.extend(files)
+        self.status = BLOCKED
+        return True
+
+    def collect(self, result):
+        # Ausgaben wandern direkt ins Archiv; danach hält der Job nur noch Namen
+        # und Größen (die Bytes selbst liegen höchstens noch im Ergebnis-Cache)
+        outputs = result["outputs"]
+        self.output_count += len(outputs)
+        if self.file_count == 1 and len(outputs) == 1:
+            # Einzelne Datei mit einem Format: Download ohne ZIP
+            self.single_output = outputs[0]
+            return
+        if self.archive is None:
+            self.archive = ArchiveBuilder()
+        with self.batch_metrics.stage("zip"):
+            for output in outputs:
+                self.archive.add(output["name"], output["content"])
+        result["outputs"] = [{"name": output["name"], "suffix": output["suffix"], "size": len(output["content"])}
+                             for output in outputs]
+
+    @property
+    def download_name(self):
+        if self.single_output is not None:
+            return self.single_output["name"]
+        return ZIP_NAME if self.archive is not None and self.output_count else None
+
+    def download_content(self):
+        if self.single_output is not None:
+            return self.single_output["content"]
+        return self.archive.read()
+
+    def finish(self):
+        if not self.consolidated:
+            cache_hits = sum(1 for result in self.results if result.get("cached"))
+            reused = sum(1 for result in self.results if result.get("reused"))
+            self.log.append(
+                f"🗄️ Cache: {cache_hits} Treffer (davon {reused} von der USK-Änderung nicht "
+                f"betroffen), {len(self.results) - cache_hits} neu konvertiert")
+        checked = [result["reconciliation"] for result in self.results if result.get("reconciliation")]
+        if checked:
+            mismatches = sum(1 for summary in checked if not is_balanced(summary))
+            self.log.append(f"🧮 Abgleich: {len(checked)} Dateien gegen den Kopfbetrag geprüft, "
+                            f"{mismatches} Abweichungen")
+        if self.archive is not None:
+            if checked:
+                # Summen pro USK/Verfahren/Bezahlmethode über den ganzen Stapel
+                with self.batch_metrics.stage("reconcile"):
+                    summary = summary_workbook(self.results)
+                self.archive.add(SUMMARY_NAME, summary)
+                self.output_count += 1
+            with self.batch_metrics.stage("zip"):
+                self.archive.close()
+        elif checked and self.single_output is not None:
+            with self.batch_metrics.stage("reconcile"):
+                summary = summary_workbook(self.results)
+            self.summary_output = {"name": SUMMARY_NAME, "suffix": ".xlsx", "content": summary}
+        if self.workbook is not None:
+            converted = [result for result in self.results if result["outputs"]]
+            if converted:
+                # Abgleich und Summen als weitere Blätter, der Download bleibt eine Datei
+                with self.batch_metrics.stage("reconcile"):
+                    add_summary_sheets(self.workbook.workbook, converted)
+                with self.batch_metrics.stage("write"):
+                    content = self.workbook.close()
+                self.single_output = {"name": CONSOLIDATED_NAME, "suffix": ".xlsx", "content": content}
+                self.output_count = 1
+                records = sum(result["outputs"][0]["records"] for result in converted)
+                self.log.append(f"📒 {len(converted)} Dateien mit {records} Datensätzen in {CONSOLIDATED_NAME} "
+                                f"zusammengefasst")
+            else:
+                self.workbook.close()
+            self.workbook = None
+
+        self.record()
+
+        # Optional als JSON oder Prometheus-Textdatei, siehe INVOICE_PARSER_METRICS_FILE
+        registry.record_batch(self.results, self.batch_metrics)
+        metrics_file = os.environ.get("INVOICE_PARSER_METRICS_FILE")
+        if metrics_file:
+            try:
+                registry.dump(metrics_file)
+            except Exception as e:
+                self.log.append(f"⚠️ Metriken konnten nicht geschrieben werden: {e}")
+
+    def snapshot(self):
+        # Konsistenter Stand für die Anzeige; Datensätze laufender Dateien kommen
+        # aus den Fortschrittszählern der Worker
+        with self.lock:
+            finished = [index for index, result in enumerate(self.results) if result is not None]
+            log = list(self.log)
+        records_total = sum(self.file_records) if self.file_records is not None else None
+        records_done = 0
+        if self.file_records is not None:
+            running = dict(self.progress)
+            for index, records in enumerate(self.file_records):
+                records_done += records if self.results[index] is not None else min(running.get(index, 0), records)
+        return {
+            "status": self.status,
+            "files_total": self.file_count,
+            "files_done": len(finished),
+            "records_total": records_total,
+            "records_done": records_done,
+            "log": log,
+            "seconds": self.seconds,
+            "queue_position": scheduler.position(self) if self.status == WAITING else None,
+            "memory_mb": self.memory_mb,
+            "scheduler": scheduler.state(),
+        }
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _evict_expired():
+    # Aufrufer hält _jobs_lock
+    ttl = float(os.environ.get("INVOICE_PARSER_JOB_TTL", DEFAULT_JOB_TTL))
+    now = time.monotonic()
+    for session_key, job in list(_jobs.items()):
+        if job.done and job.finished_at is not None and now - job.finished_at > ttl:
+            del _jobs[session_key]
+            job.release()
+
+
+def start_job(session_key, files, usk_config, formats=DEFAULT_FORMATS, cache=None, workers=None,
+              consolidated=False):
+    # Pro Sitzung läuft höchstens ein Stapel
+    # Jede Tabellenänderung startet einen neuen Job derselben Sitzung (lineage)
+    job = ConversionJob(files, usk_config, formats, cache, workers, consolidated, session_key, session_key)
+    with _jobs_lock:
+        _evict_expired()
+        previous = _jobs.get(session_key)
+        _jobs[session_key] = job
+    if previous is not None:
+        previous.cancel()
+        if previous.done:
+            previous.release()
+    return job.start()
+
+
+def cancel_job(session_key):
+    with _jobs_lock:
+        _evict_expired()
+        job = _jobs.pop(session_key, None)
+    if job is not None:
+        job.cancel()
+        if job.done:
+            job.release()
+
+
+def current_job(session_key):
+    with _jobs_lock:
+        _evict_expired()
+        return _jobs.get(session_key)
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from Invoice import read_header
+from cache import content_hash
+
+# Verzeichnis aller bereits konvertierten epay21-Dateien (SQLite), damit doppelte
+# Uploads und sich überschneidende Exporte auffallen, bevor doppelt gebucht wird.
+# Pfad über INVOICE_PARSER_LEDGER, Standard liegt neben der USK-Liste.
+DEFAULT_LEDGER = os.path.join("configs", "ledger.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    content_hash TEXT PRIMARY KEY,
+    file_sender TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_timestamp TEXT NOT NULL,
+    period_from TEXT,
+    period_to TEXT,
+    amount TEXT,
+    first_seen TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_identity ON files (file_sender, file_name, file_timestamp);
+CREATE INDEX IF NOT EXISTS files_period ON files (file_sender, period_from, period_to);
+CREATE TABLE IF NOT EXISTS conversions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content_hash TEXT NOT NULL REFERENCES files (content_hash),
+    upload_name TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    converted_at TEXT NOT NULL,
+    session TEXT
+);
+CREATE INDEX IF NOT EXISTS conversions_file ON conversions (content_hash, converted_at);
+"""
+
+
+def _pretty(timestamp):
+    return datetime.fromisoformat(timestamp).strftime("%d.%m.%Y %H:%M")
+
+
+class Ledger:
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Eine Verbindung für alle Threads (Upload-Jobs mehrerer Sitzungen), serialisiert über lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+            # Verzeichnisse von vor der Sitzungsspalte nachrüsten
+            columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(conversions)")]
+            if "session" not in columns:
+                self.connection.execute("ALTER TABLE conversions ADD COLUMN session TEXT")
+
+    def find(self, digest, header, session=None):
+        # Bekannte Datei: gleicher Inhalt oder gleicher Kopf (Absender, Name, Zeitstempel).
+        # Mit session zählen nur Konvertierungen anderer Sitzungen: wer in seiner
+        # Sitzung die Tabelle korrigiert und neu konvertiert, bucht nicht doppelt.
+        with self.lock:
+            return self.connection.execute(
+                "SELECT f.*, c.upload_name, c.config_hash, c.converted_at FROM files f "
+                "JOIN conversions c ON c.id = (SELECT MAX(id) FROM conversions WHERE content_hash = f.content_hash "
+                "AND (:session IS NULL OR session IS NOT :session)) "
+                "WHERE f.content_hash = :hash OR (f.file_sender = :sender AND f.file_name = :name "
+                "AND f.file_timestamp = :timestamp) "
+                "ORDER BY f.content_hash = :hash DESC LIMIT 1",
+                {"hash": digest, "sender": header["FileSender"], "name": header["FileName"],
+                 "timestamp": header["FileTimestamp"], "session": session},
+            ).fetchone()
+
+    def overlaps(self, digest, header):
+        # Andere Dateien desselben Absenders, deren Zeitraum sich mit diesem überschneidet
+        if not header.get("PeriodFrom") or not header.get("PeriodTo"):
+            return []
+        with self.lock:
+            return self.connection.execute(
+                "SELECT f.*, c.upload_name FROM files f "
+                "LEFT JOIN conversions c ON c.id = (SELECT MAX(id) FROM conversions WHERE content_hash = f.content_hash) "
+                "WHERE f.file_sender = ? AND f.content_hash != ? AND NOT (f.file_name = ? AND f.file_timestamp = ?) "
+                "AND f.period_from <= ? AND f.period_to >= ? ORDER BY f.period_from",
+                (header["FileSender"], digest, header["FileName"], header["FileTimestamp"], header["PeriodTo"],
+                 header["PeriodFrom"]),
+            ).fetchall()
+
+    def record(self, digest, header, upload_name, config_hash, session=None):
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (digest, header["FileSender"], header["FileName"], header["FileTimestamp"], header.get("PeriodFrom"),
+                 header.get("PeriodTo"), header.get("Amount"), now),
+            )
+            self.connection.execute(
+                "INSERT INTO conversions (content_hash, upload_name, config_hash, converted_at, session) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (digest, upload_name, config_hash, now, session),
+            )
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger(os.environ.get("INVOICE_PARSER_LEDGER", DEFAULT_LEDGER))
+        return _ledger
+
+
+def check_files(ledger, files, session=None):
+    # Nur die Kopfdaten: liefert pro Datei {"source", "hash", "header", "messages",
+    # "duplicate"}; auch Überschneidungen innerhalb des Stapels werden gemeldet.
+    # session: eigene Konvertierungen dieser Sitzung gelten nicht als doppelt
+    checks = []
+    for name, contents in files:
+        check = {"source": name, "hash": content_hash(contents), "header": None, "messages": [], "duplicate": False}
+        checks.append(check)
+        try:
+            header = check["header"] = read_header(contents)
+        except Exception:
+            # Defekte Datei: die Konvertierung meldet den Fehler
+            continue
+        twin = next((earlier for earlier in checks[:-1] if earlier["hash"] == check["hash"]), None)
+        known = ledger.find(check["hash"], header, session)
+        if twin is not None:
+            check["duplicate"] = True
+            check["messages"].append(f"♻️ {name} ist im Upload doppelt enthalten (gleicher Inhalt wie {twin['source']}).")
+        elif known is not None:
+            check["duplicate"] = True
+            when = f"am {_pretty(known['converted_at'])}" if known["converted_at"] else "bereits"
+            if known["content_hash"] == check["hash"]:
+                check["messages"].append(
+                    f"♻️ {name} wurde {when} schon konvertiert (als {known['upload_name']}) - "
+                    f"bitte nicht doppelt buchen.")
+            else:
+                check["messages"].append(
+                    f"⚠️ {name}: Absender, Dateiname und Zeitstempel wie {known['upload_name']} (konvertiert {when}), "
+                    f"aber anderer Inhalt - bitte prüfen, welche Fassung gilt.")
+        others = [dict(row) for row in ledger.overlaps(check["hash"], header)]
+        for earlier in checks[:-1]:
+            other = earlier["header"]
+            if (other is not None and earlier["hash"] != check["hash"]
+                    and other["FileSender"] == header["FileSender"]
+                    and other.get("PeriodFrom") and other.get("PeriodTo")
+                    and other["PeriodFrom"] <= header["PeriodTo"] and other["PeriodTo"] >= header["PeriodFrom"]):
+                others.append({"upload_name": earlier["source"], "period_from": other["PeriodFrom"],
+                               "period_to": other["PeriodTo"]})
+        # Eine Meldung pro Datei, auch wenn sie mehrfach im Verzeichnis steht
+        overlapping = {}
+        for other in others:
+            overlapping.setdefault(other["upload_name"] or other["file_name"], other)
+        for other_name, other in overlapping.items():
+            check["messages"].append(
+                f"⚠️ {name}: Zeitraum {header['PeriodFrom']} bis {header['PeriodTo']} von {header['FileSender']} "
+                f"überschneidet sich mit {other_name} ({other['period_from']} bis {other['period_to']}).")
+    return checks
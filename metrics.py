@@ -0,0 +1,126 @@
+import threading
+import time
+from contextlib import contextmanager
+from json import dumps
+
+from atomic import write_atomic
+
+# Reihenfolge der Stufen in Tabelle und Export
+STAGES = ("preflight", "header", "parse", "usk", "write", "reconcile", "cache", "zip")
+STAGE_LABELS = {
+    "preflight": "Prüfung",
+    "header": "Kopf",
+    "parse": "Parsen",
+    "usk": "USK",
+    "write": "Schreiben",
+    "reconcile": "Abgleich",
+    "cache": "Cache",
+    "zip": "ZIP",
+}
+
+
+class Metrics:
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self):
+        return {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+
+
+class MetricsRegistry:
+    # Prozessweite Summen für den Prometheus-Export plus die Werte des letzten Stapels
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {"files": 0, "errors": 0, "cache_hits": 0}
+        self.counts = {}
+        self.seconds = {}
+        self.last_batch = []
+
+    def record_batch(self, results, batch_metrics=None):
+        with self.lock:
+            self.last_batch = []
+            for result in results:
+                file_metrics = result.get("metrics") or {"seconds": {}, "counts": {}}
+                self.totals["files"] += 1
+                self.totals["errors"] += 1 if result.get("error") else 0
+                self.totals["cache_hits"] += 1 if result.get("cached") else 0
+                for name, value in file_metrics["counts"].items():
+                    self.counts[name] = self.counts.get(name, 0) + value
+                for name, value in file_metrics["seconds"].items():
+                    self.seconds[name] = self.seconds.get(name, 0.0) + value
+                self.last_batch.append(dict(file_metrics, source=result["source"], error=result.get("error"),
+                                            cached=bool(result.get("cached"))))
+            if batch_metrics is not None:
+                for name, value in batch_metrics.seconds.items():
+                    self.seconds[name] = self.seconds.get(name, 0.0) + value
+                self.last_batch.append(dict(batch_metrics.as_dict(), source="(Stapel)", error=None, cached=False))
+
+    def to_json(self):
+        with self.lock:
+            return dumps({"totals": self.totals, "counts": self.counts, "seconds": self.seconds,
+                          "last_batch": self.last_batch}, ensure_ascii=False, indent=4)
+
+    def to_prometheus(self):
+        with self.lock:
+            lines = [
+                "# TYPE invoice_parser_files_total counter",
+                f"invoice_parser_files_total {self.totals['files']}",
+                "# TYPE invoice_parser_errors_total counter",
+                f"invoice_parser_errors_total {self.totals['errors']}",
+                "# TYPE invoice_parser_cache_hits_total counter",
+                f"invoice_parser_cache_hits_total {self.totals['cache_hits']}",
+                "# TYPE invoice_parser_stage_seconds_total counter",
+            ]
+            for name, value in sorted(self.seconds.items()):
+                lines.append(f'invoice_parser_stage_seconds_total{{stage="{name}"}} {value:.6f}')
+            for name, value in sorted(self.counts.items()):
+                lines.append(f"# TYPE invoice_parser_{name}_total counter")
+                lines.append(f"invoice_parser_{name}_total {value}")
+            return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # *.prom -> Prometheus-Textformat (z.B. für den node_exporter textfile collector), sonst JSON
+        content = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        write_atomic(path, content.encode("utf-8"))
+
+
+registry = MetricsRegistry()
+
+
+def timing_table(results, batch_metrics=None):
+    # Kompakte Markdown-Tabelle für das Verarbeitungsprotokoll
+    header = ["Datei", "Datensätze", "KB ein", "KB aus"] + [STAGE_LABELS[name] + " (s)" for name in STAGES] + ["Gesamt (s)"]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    rows = [(result["source"], result.get("metrics")) for result in results]
+    if batch_metrics is not None:
+        rows.append(("(Stapel)", batch_metrics.as_dict()))
+    for source, file_metrics in rows:
+        file_metrics = file_metrics or {"seconds": {}, "counts": {}}
+        seconds, counts = file_metrics["seconds"], file_metrics["counts"]
+        cells = [
+            source,
+            str(counts.get("records", "")),
+            f"{counts['bytes_in'] / 1024:.0f}" if "bytes_in" in counts else "",
+            f"{counts['bytes_out'] / 1024:.0f}" if "bytes_out" in counts else "",
+        ]
+        cells += [f"{seconds[name]:.3f}" if name in seconds else "" for name in STAGES]
+        cells.append(f"{sum(seconds.values()):.3f}")
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
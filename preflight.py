@@ -0,0 +1,62 @@
+from Invoice import iter_usk_fields
+from config_store import BASIS
+from usk import UnknownUSKError, USKResolver
+
+# Vorabprüfung eines Stapels: liest nur epay21App und Purpose, löst gegen die
+# aktuelle USK-Liste auf und sammelt alle fehlenden Zuordnungen auf einmal,
+# ohne Ausgaben zu erzeugen. Konvertiert wird erst, wenn nichts fehlt.
+
+
+def scan_file(name, contents, resolver):
+    # Ergebnis: {"records", "missing": {(App, Schlüssel): Anzahl}, "error"}
+    missing = {}
+    records = 0
+    try:
+        for app, purpose in iter_usk_fields(contents):
+            records += 1
+            if app is None:
+                # Ohne epay21App scheitert die Konvertierung ohnehin mit eigener Meldung
+                continue
+            try:
+                resolver.resolve(app, purpose)
+            except UnknownUSKError as e:
+                missing[(e.app, e.key)] = missing.get((e.app, e.key), 0) + 1
+        error = None
+    except Exception as e:
+        error = str(e)
+    return {"source": name, "records": records, "missing": missing, "error": error}
+
+
+def merge(scans):
+    # Fasst die Ergebnisse pro Datei zu einem Bericht zusammen, häufigste Lücken zuerst
+    entries = {}
+    for scan in scans:
+        for (app, key), count in scan["missing"].items():
+            entry = entries.setdefault((app, key), {
+                "app": app,
+                "key": key,
+                # Zeile für die USK-Tabelle: App-Gruppe mit Schlüssel, sonst BASIS mit App-Name
+                "group": BASIS if key is None else app,
+                "name": app if key is None else key,
+                "count": 0,
+                "files": [],
+            })
+            entry["count"] += count
+            entry["files"].append(scan["source"])
+    return {
+        "files": len(scans),
+        "records": sum(scan["records"] for scan in scans),
+        "missing": sorted(entries.values(), key=lambda entry: (-entry["count"], entry["group"], entry["name"] or "")),
+        "errors": {scan["source"]: scan["error"] for scan in scans if scan["error"]},
+    }
+
+
+def scan_files(files, usk_config):
+    # files: Liste von (Dateiname, Inhalt); seriell, siehe conversion.scan_batch für den Pool
+    resolver = USKResolver(usk_config)
+    return merge([scan_file(name, contents, resolver) for name, contents in files])
+
+
+def missing_message(entry):
+    files = ", ".join(entry["files"])
+    return f"❌ {UnknownUSKError(entry['app'], entry['key'])} ({entry['count']}x in {files})"
@@ -0,0 +1,158 @@
+import io
+
+import pandas as pd
+import xlsxwriter
+
+# Abgleich der Datensatz-Beträge mit dem Kopfbetrag (PSPData/Amount) und Summen
+# pro USK, Verfahren und Bezahlmethode. Gerechnet wird in ganzen Cent (Int64),
+# nie mit float, damit Summen exakt mit der Buchhaltung übereinstimmen.
+
+CHUNK_ROWS = 50000
+GROUP_COLUMNS = ["usk", "app", "pay_method"]
+SUMMARY_NAME = "abstimmung.xlsx"
+# "12", "12.5", "-0.99", auch mit Komma; mehr als zwei Nachkommastellen sind ungültig
+AMOUNT_PATTERN = r"^\s*([+-]?)(\d*)(?:[.,](\d{1,2}))?\s*$"
+
+
+def to_cents(amounts):
+    # Vektorisiert: Series/Liste von Betragstexten -> Int64-Series, ungültig = <NA>
+    text = pd.Series(amounts, dtype=object).astype("string")
+    parts = text.str.extract(AMOUNT_PATTERN)
+    valid = parts[1].notna() & ((parts[1] != "") | parts[2].notna())
+    units = parts[1].where(parts[1] != "", "0").astype("Int64")
+    fraction = parts[2].fillna("").str.ljust(2, "0").astype("Int64")
+    cents = units * 100 + fraction
+    cents = cents.where(parts[0] != "-", -cents)
+    return cents.where(valid, pd.NA)
+
+
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+class AmountTotals:
+    # Bekommt in Invoice.export dieselben Zeilenwerte wie die Writer und fasst
+    # blockweise zusammen; der Speicherbedarf hängt nur von der Anzahl Gruppen ab
+
+    def __init__(self):
+        self.pending = []
+        self.groups = None
+        self.records = 0
+        self.invalid = 0
+        self.invalid_example = None
+
+    def write_row(self, values):
+        # values in Spaltenreihenfolge: Verfahren, USK, Betrag, ..., Bezahlmethode
+        self.pending.append((values[1], values[0], values[7], values[2]))
+        if len(self.pending) >= CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        frame = pd.DataFrame(self.pending, columns=GROUP_COLUMNS + ["amount"], dtype=object)
+        self.pending = []
+        frame["cents"] = to_cents(frame["amount"])
+        invalid = frame["cents"].isna()
+        self.records += len(frame)
+        if invalid.any():
+            self.invalid += int(invalid.sum())
+            if self.invalid_example is None:
+                self.invalid_example = frame.loc[invalid, "amount"].iloc[0]
+            frame = frame[~invalid]
+        grouped = frame.groupby(GROUP_COLUMNS, dropna=False)["cents"].agg(["sum", "count"])
+        if self.groups is not None:
+            grouped = pd.concat([self.groups, grouped]).groupby(level=GROUP_COLUMNS, dropna=False).sum()
+        self.groups = grouped
+
+    def summary(self, header_amount):
+        # Klein und picklebar, damit es aus dem Worker zurück und in den Cache passt
+        self.flush()
+        header_cents = to_cents([header_amount]).iloc[0]
+        groups = []
+        if self.groups is not None:
+            for (usk, app, pay_method), row in self.groups.iterrows():
+                groups.append([usk, app, pay_method, int(row["sum"]), int(row["count"])])
+        return {
+            "header_amount": header_amount,
+            "header_cents": None if pd.isna(header_cents) else int(header_cents),
+            "records_cents": sum(group[3] for group in groups),
+            "records": self.records,
+            "invalid": self.invalid,
+            "invalid_example": self.invalid_example,
+            "groups": groups,
+        }
+
+
+def is_balanced(summary):
+    return not summary["invalid"] and summary["header_cents"] == summary["records_cents"]
+
+
+def mismatch_message(source, summary):
+    # Protokollzeile für eine Datei, None wenn alles stimmt
+    if summary is None or is_balanced(summary):
+        return None
+    if summary["header_cents"] is None:
+        return f"⚠️ {source}: Kopfbetrag '{summary['header_amount']}' ist kein gültiger Betrag."
+    if summary["invalid"]:
+        return (f"⚠️ {source}: {summary['invalid']} Datensätze mit ungültigem Betrag "
+                f"(z.B. '{summary['invalid_example']}'), Abgleich mit dem Kopfbetrag nicht möglich.")
+    difference = summary["records_cents"] - summary["header_cents"]
+    return (f"⚠️ {source}: Summe der Datensätze {format_cents(summary['records_cents'])} weicht vom "
+            f"Kopfbetrag {format_cents(summary['header_cents'])} ab (Differenz {format_cents(difference)}).")
+
+
+def batch_totals(results):
+    # Summen über alle Dateien eines Stapels, sortiert nach USK
+    frames = [pd.DataFrame(result["reconciliation"]["groups"], columns=GROUP_COLUMNS + ["cents", "count"])
+              for result in results if result.get("reconciliation")]
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame(columns=GROUP_COLUMNS + ["cents", "count"])
+    totals = pd.concat(frames).groupby(GROUP_COLUMNS, dropna=False, as_index=False)[["cents", "count"]].sum()
+    return totals.sort_values(GROUP_COLUMNS, na_position="last").reset_index(drop=True)
+
+
+def summary_workbook(results):
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {"in_memory": True})
+    add_summary_sheets(workbook, results)
+    workbook.close()
+    return buffer.getvalue()
+
+
+def add_summary_sheets(workbook, results):
+    # Blatt "Abgleich": eine Zeile pro Datei; Blatt "Summen": pro USK/Verfahren/Bezahlmethode.
+    # Zeilen werden der Reihe nach geschrieben, geht also auch mit constant_memory
+    money = workbook.add_format({"num_format": "#,##0.00"})
+    bold = workbook.add_format({"bold": True})
+
+    sheet = workbook.add_worksheet("Abgleich")
+    sheet.set_column(0, 0, 40)
+    sheet.set_column(1, 5, 18)
+    sheet.write_row(0, 0, ("Datei", "Kopfbetrag", "Summe Datensätze", "Differenz", "Datensätze", "Status"), bold)
+    row = 1
+    for result in results:
+        summary = result.get("reconciliation")
+        if not summary:
+            continue
+        sheet.write(row, 0, result["source"])
+        if summary["header_cents"] is not None:
+            sheet.write_number(row, 1, summary["header_cents"] / 100, money)
+            sheet.write_number(row, 3, (summary["records_cents"] - summary["header_cents"]) / 100, money)
+        sheet.write_number(row, 2, summary["records_cents"] / 100, money)
+        sheet.write_number(row, 4, summary["records"])
+        sheet.write(row, 5, "OK" if is_balanced(summary) else "Abweichung")
+        row += 1
+
+    sheet = workbook.add_worksheet("Summen")
+    sheet.set_column(0, 2, 18)
+    sheet.set_column(3, 4, 15)
+    sheet.write_row(0, 0, ("USK", "Verfahren", "Bezahlmethode", "Anzahl", "Summe"), bold)
+    row = 1
+    for usk, app, pay_method, cents, count in batch_totals(results).itertuples(index=False):
+        sheet.write_row(row, 0, (usk, app, pay_method))
+        sheet.write_number(row, 3, int(count))
+        sheet.write_number(row, 4, int(cents) / 100, money)
+        row += 1
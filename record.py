@@ -0,0 +1,48 @@
+# Ein RecordEntry der epay21-XML. __slots__ statt dict: weniger Speicher pro
+# Datensatz und Attributzugriff statt String-Lookups beim Schreiben der Zeilen.
+
+FIELDS = ("epay21App", "Amount", "Currency", "PayerInfo", "Purpose", "Timestamp", "PayMethod")
+# Diese Felder dürfen fehlen und erscheinen dann mit Platzhalter in den Ausgaben
+OPTIONAL_FIELDS = ("PayerInfo", "Purpose")
+MISSING = "n/v"
+
+
+class Record:
+    __slots__ = FIELDS
+
+    def __init__(self, epay21App, Amount, Currency, PayerInfo, Purpose, Timestamp, PayMethod):
+        self.epay21App = epay21App
+        self.Amount = Amount
+        self.Currency = Currency
+        self.PayerInfo = PayerInfo
+        self.Purpose = Purpose
+        self.Timestamp = Timestamp
+        self.PayMethod = PayMethod
+
+    @classmethod
+    def from_fields(cls, fields):
+        # fields: Tag -> Text eines RecordEntry; unbekannte Tags werden ignoriert.
+        # Fehlende Pflichtfelder ergeben wie beim alten dict-Zugriff einen KeyError
+        return cls(
+            fields["epay21App"],
+            fields["Amount"],
+            fields["Currency"],
+            fields.get("PayerInfo", MISSING),
+            fields.get("Purpose", MISSING),
+            fields["Timestamp"],
+            fields["PayMethod"],
+        )
+
+    def values(self, usk):
+        # Spaltenreihenfolge der Ausgaben (Invoice.columns)
+        return (self.epay21App, usk, self.Amount, self.Currency, self.PayerInfo, self.Purpose, self.Timestamp,
+                self.PayMethod)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return f"Record({', '.join(f'{field}={getattr(self, field)!r}' for field in FIELDS)})"
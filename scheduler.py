@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict, deque
+
+from conversion import available_memory_mb
+
+# Prozessweite Zulassung der Konvertierungen: alle Sitzungen (und die HTTP-API)
+# teilen sich ein Speicherbudget. Jeder Stapel wird vorher grob geschätzt und erst
+# gestartet, wenn er ins Budget passt. Gewartet wird fair: reihum über die
+# Sitzungen, innerhalb einer Sitzung in Reihenfolge. Ein Stapel, der allein schon
+# größer als das Budget ist, läuft, sobald sonst nichts läuft.
+
+# Budget über INVOICE_PARSER_MEMORY_MB, sonst drei Viertel des Container-Limits
+DEFAULT_BUDGET_MB = 2048
+# Schätzung: XML plus Ausgaben (etwa noch einmal so groß) und Zeilen/Zellen pro Datensatz
+BYTES_FACTOR = 2
+RECORD_BYTES = 1024
+# Wie oft Wartende nachsehen, ob ihr Stapel abgebrochen wurde (Sekunden)
+POLL_INTERVAL = 0.2
+
+
+def budget_mb():
+    if os.environ.get("INVOICE_PARSER_MEMORY_MB"):
+        return int(os.environ["INVOICE_PARSER_MEMORY_MB"])
+    limit = available_memory_mb()
+    return limit * 3 // 4 if limit is not None else DEFAULT_BUDGET_MB
+
+
+def estimate_mb(files, records):
+    # files: Liste von (Dateiname, Inhalt), records: Anzahl Datensätze pro Datei
+    size = sum(len(contents) for _, contents in files) * BYTES_FACTOR + sum(records) * RECORD_BYTES
+    return max(1, -(-size // (1024 * 1024)))
+
+
+class Scheduler:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.running = {}
+        # Sitzung -> wartende Stapel; die Reihenfolge der Sitzungen ist die Runde
+        self.queues = OrderedDict()
+        self.condition = threading.Condition()
+
+    def _order(self):
+        # Zulassungsreihenfolge: erst der erste Stapel jeder Sitzung, dann der zweite ...
+        queues = list(self.queues.values())
+        order = []
+        for depth in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[depth] for queue in queues if depth < len(queue))
+        return order
+
+    def _fits(self, memory):
+        return not self.running or self.used + memory <= self.budget
+
+    def admit(self, session, job, memory, cancelled):
+        # Blockiert, bis job starten darf; False, wenn cancelled() vorher wahr wird
+        with self.condition:
+            queue = self.queues.setdefault(session, deque())
+            queue.append(job)
+            admitted = False
+            try:
+                while not cancelled():
+                    if self._order()[0] is job and self._fits(memory):
+                        admitted = True
+                        self.running[job] = memory
+                        self.used += memory
+                        break
+                    self.condition.wait(POLL_INTERVAL)
+            finally:
+                queue.remove(job)
+                if not queue:
+                    del self.queues[session]
+                elif admitted:
+                    # Diese Sitzung war dran, beim nächsten Mal kommen erst die anderen
+                    self.queues.move_to_end(session)
+                self.condition.notify_all()
+            return admitted
+
+    def release(self, job):
+        with self.condition:
+            memory = self.running.pop(job, None)
+            if memory is not None:
+                self.used -= memory
+            self.condition.notify_all()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def position(self, job):
+        # 1 = als Nächstes dran, None = läuft bereits oder wartet nicht
+        with self.condition:
+            order = self._order()
+            return order.index(job) + 1 if job in order else None
+
+    def state(self):
+        with self.condition:
+            return {"budget_mb": self.budget, "used_mb": self.used, "running": len(self.running),
+                    "waiting": sum(len(queue) for queue in self.queues.values())}
+
+
+# Einer für den ganzen Prozess, wie registry und result_cache
+scheduler = Scheduler(budget_mb())
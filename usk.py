@@ -0,0 +1,124 @@
+import re
+from json import loads
+
+# Gruppe in der USK-Liste, in der pro epay21App festgelegt wird, welcher Teil des
+# Verwendungszwecks als Schlüssel dient. Wert ist ein Trennzeichen (Schlüssel =
+# Text vor dem ersten Vorkommen) oder ein regulärer Ausdruck mit "re:"-Präfix.
+RULES_KEY = "_regeln"
+
+DEFAULT_KEY_RULES = {
+    "hsh.olav": "/",
+    "civento": "-",
+}
+
+MEMO_LIMIT = 65536
+
+
+class UnknownUSKError(KeyError):
+
+    def __init__(self, app, key=None):
+        super().__init__(app, key)
+        self.app = app
+        self.key = key
+
+    def __str__(self):
+        if self.key is None:
+            return f"Keine USK für epay21App '{self.app}' hinterlegt"
+        return f"Keine USK für epay21App '{self.app}' mit Schlüssel '{self.key}' hinterlegt"
+
+
+def compile_rule(rule):
+    if not rule:
+        return lambda purpose: purpose or ""
+    if rule.startswith("re:"):
+        pattern = re.compile(rule[3:])
+
+        def extract(purpose):
+            match = pattern.match(purpose or "")
+            if match is None:
+                return purpose or ""
+            return match.group(1) if pattern.groups else match.group(0)
+        return extract
+    return lambda purpose: (purpose or "").partition(rule)[0]
+
+
+def parse_usk_liste(usk_liste):
+    return loads(usk_liste.replace("\'", "\""))
+
+
+class USKResolver:
+
+    def __init__(self, usk_config):
+        self.usk_config = usk_config
+        rules = dict(DEFAULT_KEY_RULES)
+        rules.update(usk_config.get(RULES_KEY) or {})
+        self.rules = rules
+        self.index = {}
+        self.matchers = {}
+        for app, value in usk_config.items():
+            if app == RULES_KEY:
+                continue
+            if isinstance(value, dict):
+                self.matchers[app] = compile_rule(rules.get(app, ""))
+                for key, usk in value.items():
+                    self.index[(app, key)] = usk
+            else:
+                self.index[(app, None)] = value
+        # Apps mit Schlüsselregel, aber noch ohne Gruppe: fehlende Einträge werden als
+        # (App, Schlüssel) gemeldet, nicht als eine USK für die ganze App
+        for app, rule in rules.items():
+            if (app, None) not in self.index and app not in self.matchers:
+                self.matchers[app] = compile_rule(rule)
+        self._memo = {}
+
+    # Matcher sind Closures, für Worker-Prozesse wird aus der Liste neu kompiliert
+    def __reduce__(self):
+        return type(self), (self.usk_config,)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(parse_usk_liste(config["usk"]["usk_liste"]))
+
+    def key_for(self, app, purpose):
+        matcher = self.matchers.get(app)
+        if matcher is None:
+            return None
+        return matcher(purpose)
+
+    def resolve(self, app, purpose, used=None):
+        # used: optional eine Menge pro Datei, in die das aufgelöste (App, Schlüssel)-Paar
+        # eingetragen wird. Nicht am Resolver selbst, der wird von Jobs in mehreren
+        # Threads gleichzeitig genutzt.
+        if app not in self.matchers:
+            try:
+                usk = self.index[(app, None)]
+            except KeyError:
+                raise UnknownUSKError(app) from None
+            if used is not None:
+                used.add((app, None))
+            return usk
+        try:
+            usk, index_key = self._memo[(app, purpose)]
+        except KeyError:
+            index_key = (app, self.matchers[app](purpose))
+            try:
+                usk = self.index[index_key]
+            except KeyError:
+                raise UnknownUSKError(app, index_key[1]) from None
+            if len(self._memo) >= MEMO_LIMIT:
+                self._memo.clear()
+            self._memo[(app, purpose)] = (usk, index_key)
+        if used is not None:
+            used.add(index_key)
+        return usk
+
+
+def changed_keys(old_config, new_config):
+    # (App, Schlüssel)-Paare, deren USK sich zwischen zwei USK-Listen unterscheidet.
+    # Ändert sich die Schlüsselregel einer App, gelten alle ihre Schlüssel als geändert.
+    old, new = USKResolver(old_config), USKResolver(new_config)
+    changed = {key for key in old.index.keys() | new.index.keys() if old.index.get(key) != new.index.get(key)}
+    for app in old.matchers.keys() | new.matchers.keys():
+        if old.rules.get(app, "") != new.rules.get(app, ""):
+            changed.update(key for key in old.index if key[0] == app)
+    return changed
@@ -0,0 +1,58 @@
+import logging
+import os
+import threading
+from types import SimpleNamespace
+
+# Die Konvertierung (Invoice, pandas, xlsxwriter, Worker-Pool) braucht erst der
+# erste Upload. app.py rendert ohne sie und stößt nach dem ersten Rendern
+# warm_up() an, das alles im Hintergrund lädt. Mit INVOICE_PARSER_WARMUP=0 wird
+# erst beim ersten Upload geladen, mit =modules ohne Worker-Pool.
+
+logger = logging.getLogger("Invoice Parser")
+
+_lock = threading.Lock()
+_engine = None
+_warming = None
+
+
+def engine():
+    # Beim ersten Aufruf blockierend importieren, danach sofort
+    global _engine
+    with _lock:
+        if _engine is None:
+            import jobs
+
+            _engine = SimpleNamespace(start_job=jobs.start_job, cancel_job=jobs.cancel_job,
+                                      current_job=jobs.current_job, WAITING=jobs.WAITING, CHECKING=jobs.CHECKING,
+                                      RUNNING=jobs.RUNNING, DONE=jobs.DONE, BLOCKED=jobs.BLOCKED,
+                                      CANCELLED=jobs.CANCELLED, FAILED=jobs.FAILED)
+        return _engine
+
+
+def loaded():
+    return _engine is not None
+
+
+def _warm(pool):
+    try:
+        engine()
+        if pool:
+            from conversion import warm_pool
+
+            warm_pool()
+    except Exception as e:
+        logger.warning("Vorladen der Konvertierung fehlgeschlagen: %s", e)
+
+
+def warm_up():
+    # Einmal pro Prozess; weitere Aufrufe (jede Sitzung, jeder Rerun) tun nichts
+    global _warming
+    mode = os.environ.get("INVOICE_PARSER_WARMUP", "1").lower()
+    if mode in ("0", "false", "no"):
+        return None
+    with _lock:
+        if _warming is None:
+            _warming = threading.Thread(target=_warm, args=(mode != "modules",), name="invoice-warmup",
+                                        daemon=True)
+            _warming.start()
+        return _warming